@@ -0,0 +1,239 @@
+"""
+Binary cache for the csv spectrograms and faces
+December 2019
+
+np.loadtxt on a 1025x251 spectrogram is much slower than reading the same
+matrix from a .npy file, so this script converts the voice_{n}_{m}.csv and
+face_{n}.csv trees into .npy files once, using a process pool.
+
+The cache directory keeps a manifest.json with the mtime and size of every
+source csv. Only files that are new or changed since the last run are
+converted again, and load_csv_matrix only reads the .npy file when its
+manifest entry still matches the csv on disk; otherwise it falls back to
+np.loadtxt, so a stale cache can never be read by mistake.
+
+pack_voices concatenates a list of spectrograms into one float32 backing
+file plus an index of offsets and IDs, which the lazy mode of voice_face
+memory maps instead of holding the whole corpus in RAM.
+
+USAGE:
+    python binary_cache.py data_mlsp/train_data/ data_mlsp/valid_data/ data_mlsp/facespecs/
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+from glob import glob
+from multiprocessing import Pool
+
+CACHE_DIR = "data_mlsp/npy_cache/"
+MANIFEST = "manifest.json"
+BACKING_FILE = CACHE_DIR + "voices.bin" # lazy voice_face backing file, index next to it
+# dtypes used by the csv loaders in train_eval_model.py
+DTYPES = {"voice": np.float32, "face": np.float64}
+
+_manifests = {} # cache_dir -> manifest, loaded once per process
+
+
+def cache_path(csv_file, cache_dir=CACHE_DIR):
+    """
+    Mirrors the absolute path of csv_file inside cache_dir, with a .npy extension
+    """
+    src = os.path.abspath(csv_file)
+    stem, _ = os.path.splitext(os.path.splitdrive(src)[1].lstrip(os.sep))
+    return os.path.join(cache_dir, stem + ".npy")
+
+
+def file_kind(csv_file):
+    return os.path.basename(csv_file).split('_')[0]
+
+
+def load_manifest(cache_dir=CACHE_DIR, reload=False):
+    if reload or cache_dir not in _manifests:
+        manifest_file = os.path.join(cache_dir, MANIFEST)
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                _manifests[cache_dir] = json.load(f)
+        else:
+            _manifests[cache_dir] = {}
+    return _manifests[cache_dir]
+
+
+def save_manifest(manifest, cache_dir=CACHE_DIR):
+    # write to a temporary file first so readers never see a partial manifest
+    manifest_file = os.path.join(cache_dir, MANIFEST)
+    with open(manifest_file + ".tmp", "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=1)
+    os.replace(manifest_file + ".tmp", manifest_file)
+    _manifests[cache_dir] = manifest
+
+
+def is_fresh(csv_file, manifest, dtype, cache_dir=CACHE_DIR):
+    """
+    True if the cached .npy of csv_file was converted from the current version of the file
+    """
+    entry = manifest.get(os.path.abspath(csv_file))
+    if entry is None or entry["dtype"] != np.dtype(dtype).name:
+        return False
+    stat = os.stat(csv_file)
+    return (entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size
+            and os.path.isfile(cache_path(csv_file, cache_dir)))
+
+
+def load_csv_matrix(csv_file, dtype=np.float32, cache_dir=CACHE_DIR):
+    """
+    Drop-in replacement for np.loadtxt(csv_file, delimiter=',', dtype=dtype)
+    that reads the binary cache when it is fresh.
+    """
+    if is_fresh(csv_file, load_manifest(cache_dir), dtype, cache_dir):
+        return np.load(cache_path(csv_file, cache_dir))
+    return np.loadtxt(csv_file, delimiter=',', dtype=dtype)
+
+
+def _convert(job):
+    csv_file, npy_file, dtype = job
+    stat = os.stat(csv_file)
+    matrix = np.loadtxt(csv_file, delimiter=',', dtype=dtype)
+    os.makedirs(os.path.dirname(npy_file), exist_ok=True)
+    np.save(npy_file + ".tmp.npy", matrix)
+    os.replace(npy_file + ".tmp.npy", npy_file)
+    return os.path.abspath(csv_file), {"mtime": stat.st_mtime, "size": stat.st_size,
+                                       "dtype": np.dtype(dtype).name}
+
+
+def convert(csv_files, cache_dir=CACHE_DIR, num_workers=None):
+    """
+    Converts every new or changed csv file into the cache with a process pool.
+    Returns the number of converted files.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    manifest = dict(load_manifest(cache_dir, reload=True))
+
+    jobs = []
+    for csv_file in csv_files:
+        dtype = DTYPES.get(file_kind(csv_file), np.float64)
+        if not is_fresh(csv_file, manifest, dtype, cache_dir):
+            jobs.append((csv_file, cache_path(csv_file, cache_dir), dtype))
+
+    if len(jobs) > 0:
+        with Pool(num_workers) as pool:
+            for i, (src, entry) in enumerate(pool.imap_unordered(_convert, jobs, chunksize=4)):
+                manifest[src] = entry
+                if (i+1) % 1000 == 0:
+                    # checkpoint the manifest so an interrupted run keeps its progress
+                    save_manifest(manifest, cache_dir)
+                    print("converted {}/{} files".format(i+1, len(jobs)))
+    save_manifest(manifest, cache_dir)
+    return len(jobs)
+
+
+def _load_voice(job):
+    v_file, standardize, cache_dir = job
+    matrix = load_csv_matrix(v_file, dtype=np.float32, cache_dir=cache_dir)
+    if standardize:
+        matrix = (matrix - np.mean(matrix)) / np.std(matrix)
+    return matrix.astype(np.float32)
+
+
+def source_stats(filenames):
+    stats = [os.stat(f) for f in filenames]
+    return np.array([s.st_mtime for s in stats]), np.array([s.st_size for s in stats])
+
+
+class VoiceBacking():
+    """
+    A float32 file holding N equally shaped spectrograms back to back, and its index
+    (source filenames with their mtimes/sizes, IDs, element offsets, matrix shape).
+    The memory map is opened on first access so that every DataLoader worker opens its own.
+    """
+    def __init__(self, backing_file):
+        self.backing_file = backing_file
+        index = np.load(backing_file + ".index.npz")
+        self.filenames = index["filenames"]
+        self.mtimes = index["mtimes"]
+        self.sizes = index["sizes"]
+        self.IDs = index["IDs"]
+        self.offsets = index["offsets"]
+        self.shape = tuple(int(d) for d in index["shape"])
+        self.standardize = bool(index["standardize"])
+        self._data = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def matches(self, voice_filenames, standardize):
+        """
+        True if the backing file was packed from exactly these (unchanged) files
+        """
+        if self.standardize != standardize or list(self.filenames) != list(voice_filenames):
+            return False
+        mtimes, sizes = source_stats(voice_filenames)
+        return np.array_equal(mtimes, self.mtimes) and np.array_equal(sizes, self.sizes)
+
+    def read_into(self, idx, out):
+        """
+        Copies spectrogram idx into the preallocated float32 array out
+        """
+        if self._data is None:
+            self._data = np.memmap(self.backing_file, dtype=np.float32, mode='r')
+        n = self.shape[0] * self.shape[1]
+        out[...] = self._data[self.offsets[idx]:self.offsets[idx]+n].reshape(self.shape)
+        return out
+
+
+def pack_voices(voice_filenames, IDs, backing_file=BACKING_FILE, standardize=False,
+                cache_dir=CACHE_DIR, num_workers=None):
+    """
+    Writes the spectrograms of voice_filenames back to back into backing_file,
+    parsing them with a process pool (through the .npy cache when fresh).
+    Returns the VoiceBacking of the new file.
+    """
+    os.makedirs(os.path.dirname(backing_file) or ".", exist_ok=True)
+    mtimes, sizes = source_stats(voice_filenames)
+    offsets = np.zeros(len(voice_filenames), dtype=np.int64)
+    shape = None
+    jobs = [(v_file, standardize, cache_dir) for v_file in voice_filenames]
+    with Pool(num_workers) as pool, open(backing_file + ".tmp", "wb") as out:
+        for i, matrix in enumerate(pool.imap(_load_voice, jobs, chunksize=4)):
+            if shape is None:
+                shape = matrix.shape
+            assert(matrix.shape == shape) # csv files must contain matrices of the same dimension
+            offsets[i] = i * matrix.size
+            matrix.tofile(out)
+    os.replace(backing_file + ".tmp", backing_file)
+    np.savez(backing_file + ".index.npz", filenames=np.array(voice_filenames), mtimes=mtimes,
+             sizes=sizes, IDs=np.array(IDs, dtype=np.int64), offsets=offsets,
+             shape=np.array(shape if shape is not None else (0, 0)), standardize=standardize)
+    return VoiceBacking(backing_file)
+
+
+def open_voices(voice_filenames, IDs, backing_file=BACKING_FILE, standardize=False, cache_dir=CACHE_DIR):
+    """
+    Returns the VoiceBacking for voice_filenames, packing it first if it is missing or stale
+    """
+    if os.path.isfile(backing_file + ".index.npz"):
+        backing = VoiceBacking(backing_file)
+        if backing.matches(voice_filenames, standardize):
+            return backing
+    print("Packing {} spectrograms into {}".format(len(voice_filenames), backing_file))
+    return pack_voices(voice_filenames, IDs, backing_file, standardize, cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert voice/face csv trees into a .npy cache")
+    parser.add_argument("paths", nargs="+", help="directories containing voice_*.csv and face_*.csv files")
+    parser.add_argument("--cache_dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=None, help="defaults to the number of cpus")
+    args = parser.parse_args()
+
+    csv_files = []
+    for path in args.paths:
+        csv_files += glob(os.path.join(path, "voice_*.csv")) + glob(os.path.join(path, "face_*.csv"))
+    print("{} csv files found".format(len(csv_files)))
+    n = convert(csv_files, args.cache_dir, args.workers)
+    print("{} files converted, {} already up to date".format(n, len(csv_files)-n))
+
+
+if __name__ == "__main__":
+    main()
@@ -25,6 +25,7 @@ from glob import glob
 from datetime import datetime
 import matplotlib.pyplot as plt
 import sys
+from binary_cache import load_csv_matrix, open_voices
 
 
 # TODO this weekend
@@ -37,12 +38,15 @@ voice_train_path = "data_mlsp/train_data/"
 validation_voice_filepath = "data_mlsp/valid_data/"
 face_path = "data_mlsp/facespecs/"
 AE_save_state = "./AE_model_state.pth"
+binary_cache_path = "data_mlsp/npy_cache/" # filled by binary_cache.py, csv files are parsed when stale
+voice_backing_file = "data_mlsp/npy_cache/train_voices.bin" # used by the lazy dataset
 
 # Global training parameters
 BATCH_SIZE = 5
 voice_loss = nn.MSELoss()
 LEARNING_RATE = 1e-3
 CUDA_AVAIL = False
+LAZY_DATASET = False # memory map the spectrograms instead of loading them all into RAM
 
 # Autoencoder training parameters
 AE_NUM_EPOCHS = 30
@@ -50,6 +54,9 @@ AE_NUM_EPOCHS = 30
 # Full model training parameters
 ALPHA = 0.5
 ORTHOGONALIZE_B = False
+ORTHOGONALIZE_EVERY = 1 # optimizer steps between re-orthonormalizations of B
+SOLVE_B = False # set B in closed form from the trained autoencoder instead of training the full model
+RIDGE = 1e-3 # regularization of the closed-form B (unless ORTHOGONALIZE_B)
 NUM_EPOCHS = 100
 face_loss = nn.MSELoss()
 FACE_STD = 28 # std dev of pixel values from a subsample of 93 faces. used to scale faces to have std ~= 1
@@ -162,7 +169,10 @@ def main():
         model = full_model(AE_model, face_shape=(128,128))
         if CUDA_AVAIL:
             model = model.cuda()
-        train_model(model, dataloader, face_dict)
+        if SOLVE_B:
+            solve_B(model, dataloader, face_dict)
+        else:
+            train_model(model, dataloader, face_dict)
         print("Model training complete. ", datetime.now())
 
         print("Start validating model. ", datetime.now())
@@ -212,7 +222,7 @@ class full_model(nn.Module):
         matrices = [] # the spectrograms
         for v_file in voice_filenames:
             # get spectrogram
-            matrix = np.loadtxt(v_file, delimiter=',', dtype=np.float32)
+            matrix = load_csv_matrix(v_file, dtype=np.float32, cache_dir=binary_cache_path)
             if standardize:
                 matrix = (matrix - np.mean(matrix)) / np.std(matrix)
             matrices.append(matrix)
@@ -239,7 +249,8 @@ class full_model(nn.Module):
 
 def prep_dataloader(cuda=False):
     train_voice_filenames = get_filenames(voice_train_path)
-    train_dataset = voice_face(train_voice_filenames, standardize=True)
+    train_dataset = voice_face(train_voice_filenames, standardize=True, lazy=LAZY_DATASET,
+                               backing_file=voice_backing_file)
     dataloader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True)
     if cuda:
         curr_device = torch.cuda.current_device()
@@ -260,7 +271,7 @@ def make_face_dict(path=face_path, face_std=FACE_STD, IDs=None):
         f_files = get_filenames(path, filename_format="face_*")
         for f_file in f_files:
             ID = get_n(f_file)
-            face_arr = np.loadtxt(f_file, delimiter=',').flatten()
+            face_arr = load_csv_matrix(f_file, dtype=np.float64, cache_dir=binary_cache_path).flatten()
             face_arr = face_arr / face_std # scale to have std dev ~= 1
             face_dict[ID] = face_arr
     else:
@@ -273,7 +284,7 @@ def make_face_dict(path=face_path, face_std=FACE_STD, IDs=None):
             assert(type(ID) == int)
             
             f_file = path + "face_{}.csv".format(ID)
-            face_arr = np.loadtxt(f_file, delimiter=',').flatten()
+            face_arr = load_csv_matrix(f_file, dtype=np.float64, cache_dir=binary_cache_path).flatten()
             face_arr = face_arr / face_std # scale to have std dev ~= 1
             face_dict[ID] = face_arr
     return face_dict
@@ -295,7 +306,7 @@ def get_filenames(paths, filename_format="voice_*"):
 
 
 class voice_face(Dataset):
-    def __init__(self, voice_filenames, standardize=False):
+    def __init__(self, voice_filenames, standardize=False, lazy=False, backing_file=voice_backing_file):
         """
         Preconditions: csv files must contain matrices of the same dimension
         Args:
@@ -303,11 +314,21 @@ class voice_face(Dataset):
                                               assumes format voice_{n}_{m}.csv, 
                                               where n is the data ID and m is the spectrogram number for that speaker
             standardise (boolean):            whether to standardize the spectrograms
+            lazy (boolean):                   keep only an index of offsets and IDs and read each spectrogram 
+                                              on demand from a memory-mapped float32 backing file
+            backing_file (string):            the backing file of the lazy mode, (re)packed when missing or stale
         """
         # ensure inputs are lists
         if type(voice_filenames) == str:
             voice_filenames = [voice_filenames]
         assert(type(voice_filenames) == list)
+
+        self.lazy = lazy
+        if lazy:
+            IDs = [get_n_m(v_file)[0] for v_file in voice_filenames]
+            self.backing = open_voices(voice_filenames, IDs, backing_file, standardize, binary_cache_path)
+            self.y = torch.from_numpy(self.backing.IDs)
+            return
                 
         # load voice spectrograms one by one
         face_IDs = [] # the face IDs associated with each spectrogram
@@ -318,7 +339,7 @@ class voice_face(Dataset):
             face_IDs.append(n)
             
             # get spectrogram
-            matrix = np.loadtxt(v_file, delimiter=',', dtype=np.float32)
+            matrix = load_csv_matrix(v_file, dtype=np.float32, cache_dir=binary_cache_path)
             if standardize:
                 matrix = (matrix - np.mean(matrix)) / np.std(matrix)
             matrices.append(matrix)
@@ -337,6 +358,11 @@ class voice_face(Dataset):
         return self.y.shape[0]
 
     def __getitem__(self, idx):
+        if self.lazy:
+            # allocate the sample once and copy the spectrogram straight into it
+            x = torch.empty((1,) + self.backing.shape)
+            self.backing.read_into(idx, x.numpy()[0])
+            return x, self.y[idx]
         return self.X[idx], self.y[idx]
 
 
@@ -404,6 +430,7 @@ def train_model(model, dataloader, face_dict):
     optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE, weight_decay=1e-5)
     
     loss_epochs = []
+    steps = 0
     for epoch in range(NUM_EPOCHS):
         for batch in dataloader:
             # ===================forward=====================
@@ -414,7 +441,8 @@ def train_model(model, dataloader, face_dict):
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
-            if ORTHOGONALIZE_B:
+            steps += 1
+            if ORTHOGONALIZE_B and steps % ORTHOGONALIZE_EVERY == 0:
                 model.B.weight.data = gram_schmidt(model.B.weight.data)
         # ===================log========================
         print('epoch [{}/{}], loss:{:.4f}, completed at {}'
@@ -462,6 +490,31 @@ def main_ae(dataloader):
     plt.savefig("./AE_convergence_plot.png")
 
 
+def solve_B(model, dataloader, face_dict, orthogonal=ORTHOGONALIZE_B, ridge=RIDGE):
+    """
+    Sets B in closed form from the embeddings w of the (fixed) autoencoder, in one
+    pass over the data accumulating G = sum w w^T and C = sum w f^T:
+    B = C^T (G + ridge*I)^-1, or the polar factor of C^T when B must be orthogonal
+    """
+    n = model.w_length
+    gram = torch.zeros(n, n, dtype=torch.float64)
+    cross = torch.zeros(n, model.face_length, dtype=torch.float64)
+    with torch.no_grad():
+        for voice_data, IDs in dataloader:
+            _, w = model.AE_model(voice_data)
+            w = w.double().cpu()
+            faces = torch.from_numpy(np.array([face_dict[ID.item()] for ID in IDs])).double()
+            gram += w.t() @ w
+            cross += w.t() @ faces
+        if orthogonal:
+            u, _, vh = torch.linalg.svd(cross.t(), full_matrices=False)
+            B = u @ vh
+        else:
+            B = torch.linalg.solve(gram + ridge*torch.eye(n, dtype=torch.float64), cross).t()
+        model.B.weight.copy_(B.float())
+    # saved with a fresh optimizer so that load_state can read it like a trained model
+    save_state("./model_state.pth", model, torch.optim.Adam(model.parameters(), lr=LEARNING_RATE), [])
+
 def save_state(path, model, optimizer, loss): # epoch, loss
     torch.save({
             'model': str(model),
@@ -495,24 +548,16 @@ def view_state(model, optimizer, state_size = 0):
         print(var_name, "\t", optimizer.state_dict()[var_name])
 
 def gram_schmidt(vv):
-    def projection(u, v):
-        return (v * u).sum() / (u * u).sum() * u
-
-    nk = vv.size(1) # debugged from original repo
-    uu = torch.zeros_like(vv, device=vv.device)
-    uu[:, 0] = vv[:, 0].clone() # copy first column
-    for k in range(1, nk):
-        vk = vv[:, k].clone() # debugged from original repo
-        uk = 0
-        for j in range(0, k): # project vk onto space spanned by bases so far
-            uj = uu[:, j].clone()
-            uk = uk + projection(uj, vk)
-        uu[:, k] = vk - uk
-    for k in range(nk):
-        uk = uu[:, k].clone()
-        uu[:, k] = uk / uk.norm()
-    return uu
-# source: https://github.com/legendongary/pytorch-gram-schmidt
+    """
+    Orthonormalizes the columns of vv with one Householder QR. The column signs
+    are fixed so that diag(R) is positive, which gives the same basis as the
+    classical Gram-Schmidt loop of https://github.com/legendongary/pytorch-gram-schmidt
+    without its O(k^2) tiny tensor ops.
+    """
+    q, r = torch.linalg.qr(vv)
+    signs = torch.sign(torch.diagonal(r))
+    signs[signs == 0] = 1
+    return q * signs
 
 class DeviceDataloader():
     """Wrap a dataloader to move data to a device"""
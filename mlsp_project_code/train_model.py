@@ -53,6 +53,9 @@ import matplotlib.pyplot as plt
 
 ALPHA = 0
 ORTHOGONALIZE_B = False
+ORTHOGONALIZE_EVERY = 1 # optimizer steps between re-orthonormalizations of B
+SOLVE_B = False # set B in closed form from the trained autoencoder instead of training the full model
+RIDGE = 1e-3 # regularization of the closed-form B (unless ORTHOGONALIZE_B)
 NUM_EPOCHS = 100
 BATCH_SIZE = 10
 voice_loss = nn.MSELoss()
@@ -175,7 +178,10 @@ def main():
     model = full_model(AE_model, face_shape=(128,128))
     if CUDA:
         model = model.cuda()
-    train_model(model, dataloader, face_dict)
+    if SOLVE_B:
+        solve_B(model, dataloader, face_dict)
+    else:
+        train_model(model, dataloader, face_dict)
 
     print("Model training complete. {}".format(datetime.now()))
 
@@ -371,6 +377,7 @@ def train_model(model, dataloader, face_dict):
     optimizer = torch.optim.Adam(model.parameters(), lr=LEARNING_RATE, weight_decay=1e-5)
     
     loss_epochs = []
+    steps = 0
     for epoch in range(NUM_EPOCHS):
         for batch in dataloader:
             # ===================forward=====================
@@ -381,7 +388,8 @@ def train_model(model, dataloader, face_dict):
             optimizer.zero_grad()
             loss.backward()
             optimizer.step()
-            if ORTHOGONALIZE_B:
+            steps += 1
+            if ORTHOGONALIZE_B and steps % ORTHOGONALIZE_EVERY == 0:
                 model.B.weight.data = gram_schmidt(model.B.weight.data)
         # ===================log========================
         print('epoch [{}/{}], loss:{:.4f}, completed at {}'
@@ -396,6 +404,31 @@ def train_model(model, dataloader, face_dict):
     plt.ylabel("Loss")
     plt.savefig("./convergence_plot.png")
 
+def solve_B(model, dataloader, face_dict, orthogonal=ORTHOGONALIZE_B, ridge=RIDGE):
+    """
+    Sets B in closed form from the embeddings w of the (fixed) autoencoder, in one
+    pass over the data accumulating G = sum w w^T and C = sum w f^T:
+    B = C^T (G + ridge*I)^-1, or the polar factor of C^T when B must be orthogonal
+    """
+    n = model.w_length
+    gram = torch.zeros(n, n, dtype=torch.float64)
+    cross = torch.zeros(n, model.face_length, dtype=torch.float64)
+    with torch.no_grad():
+        for voice_data, IDs in dataloader:
+            _, w = model.AE_model(voice_data)
+            w = w.double().cpu()
+            faces = torch.from_numpy(np.array([face_dict[ID.item()] for ID in IDs])).double()
+            gram += w.t() @ w
+            cross += w.t() @ faces
+        if orthogonal:
+            u, _, vh = torch.linalg.svd(cross.t(), full_matrices=False)
+            B = u @ vh
+        else:
+            B = torch.linalg.solve(gram + ridge*torch.eye(n, dtype=torch.float64), cross).t()
+        model.B.weight.copy_(B.float())
+    # saved with a fresh optimizer so that load_state can read it like a trained model
+    save_state("./model_state.pth", model, torch.optim.Adam(model.parameters(), lr=LEARNING_RATE), [])
+
 def save_state(path, model, optimizer, loss): # epoch, loss
     torch.save({
             'model': str(model),
@@ -429,24 +462,16 @@ def view_state(model, optimizer, state_size = 0):
         print(var_name, "\t", optimizer.state_dict()[var_name])
 
 def gram_schmidt(vv):
-    def projection(u, v):
-        return (v * u).sum() / (u * u).sum() * u
-
-    nk = vv.size(1) # debugged from original repo
-    uu = torch.zeros_like(vv, device=vv.device)
-    uu[:, 0] = vv[:, 0].clone() # copy first column
-    for k in range(1, nk):
-        vk = vv[:, k].clone() # debugged from original repo
-        uk = 0
-        for j in range(0, k): # project vk onto space spanned by bases so far
-            uj = uu[:, j].clone()
-            uk = uk + projection(uj, vk)
-        uu[:, k] = vk - uk
-    for k in range(nk):
-        uk = uu[:, k].clone()
-        uu[:, k] = uk / uk.norm()
-    return uu
-# source: https://github.com/legendongary/pytorch-gram-schmidt
+    """
+    Orthonormalizes the columns of vv with one Householder QR. The column signs
+    are fixed so that diag(R) is positive, which gives the same basis as the
+    classical Gram-Schmidt loop of https://github.com/legendongary/pytorch-gram-schmidt
+    without its O(k^2) tiny tensor ops.
+    """
+    q, r = torch.linalg.qr(vv)
+    signs = torch.sign(torch.diagonal(r))
+    signs[signs == 0] = 1
+    return q * signs
 
 # helper routine
 def conv_shape(L, K, S, P):
@@ -0,0 +1,149 @@
+"""
+    Existence/size index of a dataset tree, built with parallel os.scandir walks
+
+    $ python file_index.py /share/workhorse3/voxceleb/specgrams specgrams_index.npz
+
+    Running it again on an existing index only lists the directories whose
+    mtime changed since the index was built (a directory's mtime changes when
+    entries are added, removed or renamed in it), the other directories keep
+    their previous listing including the file sizes.
+"""
+import os
+import sys
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FileIndex:
+    """
+        dirs: directories relative to the root ("" is the root itself)
+        dir_mtimes: mtime of every directory when it was listed
+        files: file paths relative to the root
+        file_dirs: position in dirs of the directory of every file
+        sizes: size of every file in bytes
+    """
+
+    def __init__(self, root, dirs, dir_mtimes, files, file_dirs, sizes):
+        self.root = root
+        self.dirs = dirs
+        self.dir_mtimes = dir_mtimes
+        self.files = files
+        self.file_dirs = file_dirs
+        self.sizes = sizes
+
+    def save(self, index_file):
+        np.savez(index_file, root=np.array(self.root), dirs=self.dirs, dir_mtimes=self.dir_mtimes,
+                 files=self.files, file_dirs=self.file_dirs, sizes=self.sizes)
+
+    @classmethod
+    def load(cls, index_file):
+        index = np.load(index_file)
+        return cls(str(index["root"]), index["dirs"], index["dir_mtimes"], index["files"],
+                   index["file_dirs"], index["sizes"])
+
+    def filter_existing(self, paths, min_size=1):
+        """
+            Returns a boolean mask of the paths (absolute, or relative to the root)
+            that are files of at least min_size bytes
+        """
+        prefix = os.path.join(self.root, "")
+        relative = np.array([p[len(prefix):] if p.startswith(prefix) else p for p in paths])
+        present = self.files[self.sizes >= min_size]
+        return np.isin(relative, present)
+
+
+def _list_dir(root, relative):
+    """
+        Lists one directory: its mtime, its files with their sizes and its subdirectories
+    """
+    path = os.path.join(root, relative)
+    mtime = os.stat(path).st_mtime
+    files, sizes, subdirs = [], [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(os.path.join(relative, entry.name))
+            elif entry.is_file():
+                files.append(os.path.join(relative, entry.name))
+                sizes.append(entry.stat().st_size)
+    return mtime, files, sizes, subdirs
+
+
+def _refresh_dir(root, relative, previous):
+    """
+        Reuses the previous listing of a directory when its mtime did not change,
+        returns None for a directory that no longer exists
+    """
+    try:
+        if previous is not None and relative in previous:
+            if os.stat(os.path.join(root, relative)).st_mtime == previous[relative][0]:
+                return previous[relative], False
+        return _list_dir(root, relative), True
+    except FileNotFoundError:
+        return None
+
+
+def build_index(root, previous=None, num_threads=32):
+    """
+        Walks root breadth first, listing every level of the tree concurrently
+
+        previous: a FileIndex of the same root to refresh incrementally
+        returns the FileIndex and the number of directories that were listed
+    """
+    listings = None
+    if previous is not None:
+        # regroup the previous index per directory
+        listings = {d: (m, [], [], []) for d, m in zip(previous.dirs, previous.dir_mtimes)}
+        for f, d, s in zip(previous.files, previous.file_dirs, previous.sizes):
+            listings[previous.dirs[d]][1].append(f)
+            listings[previous.dirs[d]][2].append(s)
+        for d in previous.dirs:
+            if d != "":
+                listings[os.path.dirname(d)][3].append(d)
+
+    dirs, dir_mtimes, files, file_dirs, sizes = [], [], [], [], []
+    listed = 0
+    level = [""]
+    with ThreadPoolExecutor(num_threads) as pool:
+        while level:
+            next_level = []
+            for relative, refreshed in zip(level, pool.map(lambda d: _refresh_dir(root, d, listings), level)):
+                if refreshed is None:
+                    continue
+                (mtime, dir_files, dir_sizes, subdirs), fresh = refreshed
+                listed += fresh
+                files += dir_files
+                sizes += dir_sizes
+                file_dirs += [len(dirs)]*len(dir_files)
+                dirs.append(relative)
+                dir_mtimes.append(mtime)
+                next_level += subdirs
+            level = next_level
+
+    index = FileIndex(root, np.array(dirs), np.array(dir_mtimes), np.array(files),
+                      np.array(file_dirs, dtype=np.int64), np.array(sizes, dtype=np.int64))
+    return index, listed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root")
+    parser.add_argument("index_file")
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rebuild", action="store_true", help="ignore the existing index")
+    args = parser.parse_args()
+
+    previous = None
+    if os.path.isfile(args.index_file) and not args.rebuild:
+        previous = FileIndex.load(args.index_file)
+        if previous.root != args.root:
+            print("{} indexes {}, not {}".format(args.index_file, previous.root, args.root))
+            sys.exit(1)
+    index, listed = build_index(args.root, previous, args.threads)
+    index.save(args.index_file)
+    print("{} files in {} directories, {} directories listed".format(len(index.files), len(index.dirs), listed))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,21 @@ import numpy as np
 from random import randint
 from torch.utils.data import Dataset
 from collections import defaultdict
+from file_index import FileIndex
 
 class VoxCeleb(Dataset):
-    def __init__(self, data_dir, specgrams_dir, root_path, file_extension, dataset_type, segment_length=400):
+    """
+        specgrams_dir: file listing the spectrograms that exist, used to drop missing files
+        file_index: index built by file_index.py for root_path, used instead of specgrams_dir
+                    to drop missing or empty files
+    """
+    def __init__(self, data_dir, specgrams_dir, root_path, file_extension, dataset_type, segment_length=400,
+                 file_index=None):
         types = {"train": 1, "val": 2, "test": 3}
         label_type = types[dataset_type]
         self.segment_length = segment_length
-        self.dataset, self.labels = self.read_dataset(data_dir, specgrams_dir, root_path, file_extension, label_type)
+        self.dataset, self.labels = self.read_dataset(data_dir, specgrams_dir, root_path, file_extension, label_type,
+                                                      file_index)
 
     def __len__(self):
         return len(self.dataset)
@@ -17,7 +25,8 @@ class VoxCeleb(Dataset):
     def __getitem__(self, index):
         x, y = self.dataset[index]
         # try:
-        x = np.load(x)
+        # memory-mapped so only the header and the cropped frames are read
+        x = np.load(x, mmap_mode="r")
         # except:
         #     x = np.zeros((257,self.segment_length))
         y = self.labels.index(y)
@@ -32,7 +41,7 @@ class VoxCeleb(Dataset):
         new_x[:, :end-start] = x[:, start:end]
         return new_x, y
 
-    def read_dataset(self, data_dir, specgrams_dir, root_path, file_extension, label_type):
+    def read_dataset(self, data_dir, specgrams_dir, root_path, file_extension, label_type, file_index=None):
         all_specgrams = defaultdict(lambda:len(all_specgrams))
         all_files = []
         labels = set()
@@ -40,9 +49,10 @@ class VoxCeleb(Dataset):
             label_type = [1,2]
         else:
             label_type = [3]
-        with open(specgrams_dir, "r") as f:
-            for line in f.readlines():
-                all_specgrams[line.strip()]
+        if file_index is None:
+            with open(specgrams_dir, "r") as f:
+                for line in f.readlines():
+                    all_specgrams[line.strip()]
         with open(data_dir, "r") as f:
             for line in f.readlines():
                 label, filepath = line.strip().split(" ")
@@ -57,10 +67,15 @@ class VoxCeleb(Dataset):
                 # too slow to call on workhorse...
                 # if not os.path.isfile(filepath):
                 #     continue
-                if filepath not in all_specgrams:
+                if file_index is None and filepath not in all_specgrams:
                     continue
                 all_files.append((filepath, speaker_id))
 
+        if file_index is not None:
+            # one vectorized membership test instead of a stat per file
+            exists = FileIndex.load(file_index).filter_existing([x for x, _ in all_files])
+            all_files = [f for f, keep in zip(all_files, exists) if keep]
+
         labels_to_return = sorted(list(labels))
         with open("/home/mahmoudi/workhorse3/voice_to_face_net/template_labels.txt", "w") as f:
             for x in labels_to_return:
@@ -0,0 +1,135 @@
+"""
+    Measures how data-parallel training of train.py scales from 1 to N cpu
+    processes (gloo) on a synthetic dataset of random spectrograms and faces
+
+    Every process takes its shard of the epoch through ResumableBatchSampler,
+    the gradients of both networks are averaged by GradientAllReduce before
+    every Adam step and the dictionary is re-orthonormalized and broadcast from
+    rank 0, as in train.py. The cores are split equally between the processes.
+
+    Reported per process count: samples/sec over all ranks, speedup and
+    efficiency against one process, time of the gradient all-reduce per step,
+    and the largest parameter difference between the ranks at the end (0 when
+    they stay in sync).
+
+    $ python benchmark_distributed.py --processes 1 2 4 8 --batch-size 8
+"""
+import os
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from itertools import chain
+from torch.utils.data import BatchSampler, RandomSampler
+from networks import VGGVoxWrapper, Dictionary
+from orthogonal import Orthogonalizer
+from sampler import ResumableBatchSampler
+from device import configure_cpu_threads
+from distributed import broadcast_state, GradientAllReduce
+
+
+def synthetic_dataset(size, segment_length, seed=0):
+    """
+        Random (spectrogram, face, label) tensors, the same on every rank
+    """
+    generator = torch.Generator().manual_seed(seed)
+    utt = torch.randn(size, 257, segment_length, generator=generator)
+    face = torch.randint(0, 256, (size, 128*128), dtype=torch.uint8, generator=generator)
+    y = torch.randint(0, 1251, (size,), generator=generator)
+    return utt, face, y
+
+
+def worker(rank, world_size, args, results):
+    dist.init_process_group("gloo", init_method="tcp://127.0.0.1:{}".format(args.port),
+                            rank=rank, world_size=world_size)
+    threads = configure_cpu_threads(0, args.threads, world_size)
+
+    utt, face, y = synthetic_dataset(args.dataset_size, args.segment_length)
+    sampler = ResumableBatchSampler(BatchSampler(RandomSampler(range(args.dataset_size)), args.batch_size,
+                                                 drop_last=True), num_replicas=world_size, rank=rank)
+    torch.manual_seed(rank)
+    voice_network = VGGVoxWrapper(257, 128)
+    face_network = Dictionary(128, 128*128)
+    networks = [voice_network, face_network]
+    broadcast_state(networks)
+    orthogonalizer = Orthogonalizer(face_network.linear, every=args.orthogonalize_every, broadcast=True)
+    parameters = list(chain(voice_network.parameters(), face_network.parameters()))
+    optimizer = optim.Adam(parameters, lr=1e-3)
+    all_reduce = GradientAllReduce(parameters)
+    cross_entropy, mse = nn.CrossEntropyLoss(), nn.MSELoss()
+
+    def batches():
+        epoch = 0
+        while True:
+            sampler.set_epoch(epoch)
+            for batch in sampler:
+                yield utt[batch], face[batch], y[batch]
+            epoch += 1
+
+    reduce_time = 0.0
+    data = batches()
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            dist.barrier()
+            start = time.time()
+            reduce_time = 0.0
+        x, f, labels = next(data)
+        optimizer.zero_grad()
+        embedding = voice_network(x)
+        loss = cross_entropy(voice_network(embedding, loss=True), labels) + mse(face_network(embedding), f.float())
+        loss.backward()
+        reduced = time.time()
+        all_reduce()
+        reduce_time += time.time() - reduced
+        optimizer.step()
+        orthogonalizer.step()
+    # the slowest rank sets the pace
+    elapsed = torch.tensor([time.time() - start, reduce_time])
+    dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)
+
+    # largest difference of any parameter to rank 0
+    with torch.no_grad():
+        flat = torch.cat([p.detach().reshape(-1) for p in parameters])
+        reference = flat.clone()
+        dist.broadcast(reference, 0)
+        drift = (flat - reference).abs().max().reshape(1)
+        dist.all_reduce(drift, op=dist.ReduceOp.MAX)
+
+    if rank == 0:
+        rate = world_size*args.steps*args.batch_size/elapsed[0].item()
+        results.put((rate, 1000*elapsed[1].item()/args.steps, drift.item(), threads))
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=8, help="per process")
+    parser.add_argument("--segment-length", type=int, default=200)
+    parser.add_argument("--dataset-size", type=int, default=512)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads per process, default cores/processes")
+    parser.add_argument("--orthogonalize-every", type=int, default=1)
+    parser.add_argument("--port", type=int, default=29533)
+    args = parser.parse_args()
+
+    print("{} cores, batch size {} per process, {} frames".format(os.cpu_count(), args.batch_size,
+                                                                   args.segment_length))
+    context = mp.get_context("spawn")
+    baseline = None
+    for n in args.processes:
+        results = context.SimpleQueue()
+        mp.spawn(worker, args=(n, args, results), nprocs=n)
+        rate, reduce_ms, drift, threads = results.get()
+        baseline = baseline or rate/n
+        print("{:>3} processes ({:>2} threads each): {:8.2f} samples/sec   {:.2f}x   efficiency {:5.1f}%   "
+              "all-reduce {:7.2f} ms/step   max rank difference {:.1e}".format(
+                  n, threads, rate, rate/baseline, 100*rate/(baseline*n), reduce_ms, drift))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+    Measures data loading throughput (samples/sec) of VoxCelebVGGFace
+
+    per-item: the DataLoader fetches and collates one sample at a time
+    batch: every worker builds a whole batch with dataset.get_batch
+           (with --crops-per-utterance K, K crops of every utterance it loads)
+    read-ahead: a thread pool reads the next --depth batches concurrently
+
+    $ python benchmark_loader.py vgg_voxceleb_edge_preserving.txt --face-store packed/faces --workers 8
+"""
+import time
+import argparse
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
+from dataloader import VoxCelebVGGFace, collate
+from readahead import ReadAheadLoader
+
+
+def per_item_loader(dataset, args):
+    return DataLoader(dataset, args.batch_size, shuffle=True, num_workers=args.workers, drop_last=True,
+                      collate_fn=collate)
+
+
+def batch_loader(dataset, args):
+    utterances_per_batch = max(1, args.batch_size // dataset.crops_per_utterance)
+    sampler = BatchSampler(RandomSampler(dataset), utterances_per_batch, drop_last=True)
+    return DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=args.workers)
+
+
+def read_ahead_loader(dataset, args):
+    utterances_per_batch = max(1, args.batch_size // dataset.crops_per_utterance)
+    sampler = BatchSampler(RandomSampler(dataset), utterances_per_batch, drop_last=True)
+    return ReadAheadLoader(dataset, sampler, depth=args.depth, num_threads=args.threads)
+
+
+MODES = {"per-item": per_item_loader, "batch": batch_loader, "read-ahead": read_ahead_loader}
+
+
+def throughput(loader, n_batches):
+    """
+        samples/sec over n_batches, after a first batch that absorbs the worker start-up
+    """
+    iterator = iter(loader)
+    next(iterator)
+    samples = 0
+    start = time.time()
+    for _ in range(n_batches):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            break
+        samples += batch[0].size(0)
+    return samples / (time.time() - start)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("dataset_mapping")
+    parser.add_argument("--spectrogram-store", default=None)
+    parser.add_argument("--face-store", default=None)
+    parser.add_argument("--lengths-index", default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--crops-per-utterance", type=int, default=1, help="used by the batch modes")
+    parser.add_argument("--depth", type=int, default=8, help="batches read ahead")
+    parser.add_argument("--threads", type=int, default=32, help="concurrent reads of the read-ahead mode")
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    return parser
+
+
+def main():
+    args = make_parser().parse_args()
+    dataset = VoxCelebVGGFace(args.dataset_mapping, ["train"], spectrogram_store=args.spectrogram_store,
+                              face_store=args.face_store, lengths_index=args.lengths_index)
+    multi_crop = VoxCelebVGGFace(args.dataset_mapping, ["train"], spectrogram_store=args.spectrogram_store,
+                                 face_store=args.face_store, lengths_index=args.lengths_index,
+                                 crops_per_utterance=args.crops_per_utterance)
+    print("{} samples, batch size {}, {} workers".format(len(dataset), args.batch_size, args.workers))
+    for mode in args.modes:
+        loader = MODES[mode](dataset if mode == "per-item" else multi_crop, args)
+        rate = throughput(loader, args.batches)
+        print("{:>10}: {:10.1f} samples/sec".format(mode, rate))
+        if hasattr(loader, "stats"):
+            print("            " + "   ".join("{}: {:.1f}".format(k, v) for k, v in loader.stats().items()))
+
+
+if __name__ == "__main__":
+    main()
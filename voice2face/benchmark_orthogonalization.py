@@ -0,0 +1,91 @@
+"""
+    Measures the time of one training step of the face dictionary (Adam step
+    plus orthogonalization) for every orthogonalization method, after checking
+    that the QR path returns the same basis as gram_schmidt
+
+    The dictionary of train.py maps 1024 hidden units to 128*128 pixels, the
+    reference gram_schmidt takes minutes per step at that size, so it can be
+    benchmarked on fewer columns with --columns.
+
+    $ python benchmark_orthogonalization.py --columns 256 --steps 5
+"""
+import sys
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from orthogonal import METHODS, Orthogonalizer, gram_schmidt, qr_orthonormalize, orthogonality_error
+
+
+def check_equivalence(rows, columns, device, tolerance):
+    """
+        Max abs difference between gram_schmidt and qr_orthonormalize on a
+        freshly initialized weight and on one perturbed by an update
+    """
+    weight = nn.Linear(columns, rows, bias=False).weight.data.to(device)
+    perturbed = gram_schmidt(weight)
+    perturbed += 1e-3*torch.randn_like(perturbed)
+    worst = 0.0
+    for w in (weight, perturbed):
+        reference, fast = gram_schmidt(w), qr_orthonormalize(w)
+        worst = max(worst, (reference - fast).abs().max().item())
+        print("    max |gram_schmidt - qr| {:.2e}   orthogonality error: gram_schmidt {:.2e}, qr {:.2e}".format(
+            (reference - fast).abs().max().item(), orthogonality_error(reference), orthogonality_error(fast)))
+    return worst <= tolerance
+
+
+def step_time(method, every, rows, columns, device, n_steps):
+    """
+        Average seconds per step (backward, Adam step, orthogonalization) over n_steps
+    """
+    dictionary = nn.Linear(columns, rows, bias=False).to(device)
+    orthogonalizer = Orthogonalizer(dictionary, method=method, every=every)
+    optimizer = optim.Adam(dictionary.parameters(), lr=1e-3)
+    x = torch.randn(32, columns, device=device)
+    target = torch.randn(32, rows, device=device)
+
+    def step():
+        optimizer.zero_grad()
+        loss = ((dictionary(x) - target)**2).mean()
+        loss.backward()
+        optimizer.step()
+        orthogonalizer.step()
+
+    step() # warm up
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start)/n_steps, orthogonality_error(dictionary.weight.detach())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=128*128)
+    parser.add_argument("--columns", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--every", type=int, nargs="+", default=[1, 10], help="schedules to time for qr")
+    parser.add_argument("--methods", nargs="+", default=list(METHODS), choices=list(METHODS))
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="allowed |gram_schmidt - qr|")
+    parser.add_argument("--cpu", action="store_true")
+    args = parser.parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+
+    print("{}x{} dictionary on {}".format(args.rows, args.columns, device))
+    if not check_equivalence(args.rows, args.columns, device, args.tolerance):
+        print("qr_orthonormalize does not match gram_schmidt within {}".format(args.tolerance))
+        sys.exit(1)
+
+    for method in args.methods:
+        for every in (args.every if method == "qr" else [1]):
+            seconds, error = step_time(method, every, args.rows, args.columns, device, args.steps)
+            name = method if every == 1 else "{} every {}".format(method, every)
+            print("{:>16}: {:10.2f} ms/step   orthogonality error {:.2e}".format(name, 1000*seconds, error))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+    Measures training throughput (samples/sec) of the voice and face networks
+    on random batches, comparing a naive cpu port of train.py (torch default
+    threads, contiguous float32) with the cpu options of train.py added one
+    at a time
+
+    naive: default intra-op threads, contiguous layout, float32
+    threads: intra-op threads set by configure_cpu_threads for --workers DataLoader workers
+    channels-last: threads + channels-last convolutions
+    bf16: threads + channels-last + bfloat16 autocast (only when the cpu supports it natively)
+
+    Every step also records its three losses, either with .item() on each of them
+    like train.py used to (--metrics item, one host sync per call) or in a
+    RunningMetrics buffer copied to the host every --log-every steps
+    (--metrics buffered, the default). --metrics item buffered times both.
+
+    $ python benchmark_training.py --batch-size 16 --workers 8
+"""
+import time
+import argparse
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from itertools import chain
+from networks import VGGVoxWrapper, Dictionary
+from metrics import RunningMetrics
+from device import select_device, bf16_supported, configure_cpu_threads, prepare_network, autocast
+
+
+CONFIGS = {"naive": {"threads": False, "channels_last": False, "bf16": False},
+           "threads": {"threads": True, "channels_last": False, "bf16": False},
+           "channels-last": {"threads": True, "channels_last": True, "bf16": False},
+           "bf16": {"threads": True, "channels_last": True, "bf16": True}}
+
+
+def throughput(config, args, device, metrics="buffered"):
+    """
+        samples/sec over args.steps training steps, after args.warmup steps
+    """
+    default_threads = torch.get_num_threads()
+    threads = configure_cpu_threads(args.workers, args.threads) if config["threads"] else default_threads
+
+    voice_network = prepare_network(VGGVoxWrapper(257, 128), device, config["channels_last"])
+    face_network = Dictionary(128, 128*128).to(device)
+    optimizer = optim.Adam(chain(voice_network.parameters(), face_network.parameters()), lr=1e-3)
+    utt = torch.randn(args.batch_size, 257, args.segment_length, device=device)
+    face = torch.randint(0, 256, (args.batch_size, 128*128), dtype=torch.uint8, device=device)
+    y = torch.randint(0, 1251, (args.batch_size,), device=device)
+    cross_entropy, mse = nn.CrossEntropyLoss(), nn.MSELoss()
+    buffer = RunningMetrics(["LOSS", "SPEAKER ID LOSS", "FACE RECONSTRUCTION"], device, args.log_every)
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device, config["bf16"]):
+            embedding = voice_network(utt)
+            gen_face = face_network(embedding)
+            logits = voice_network(embedding, loss=True)
+        loss_speakerid = cross_entropy(logits.float(), y)
+        loss_face_recon = mse(gen_face.float(), face.float())
+        loss = loss_speakerid + loss_face_recon
+        loss.backward()
+        optimizer.step()
+        if metrics == "item":
+            losses = {"LOSS": loss.item(), "SPEAKER ID LOSS": loss_speakerid.item(),
+                      "FACE RECONSTRUCTION": loss_face_recon.item()}
+        else:
+            buffer.add(loss, loss_speakerid, loss_face_recon)
+            if buffer.due():
+                buffer.flush()
+
+    for _ in range(args.warmup):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    rate = args.steps*args.batch_size/(time.time() - start)
+    torch.set_num_threads(default_threads)
+    return rate, threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--segment-length", type=int, default=400)
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--workers", type=int, default=0, help="DataLoader workers the cores are shared with")
+    parser.add_argument("--threads", type=int, default=None, help="explicit intra-op threads")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument("--metrics", nargs="+", default=["buffered"], choices=["item", "buffered"])
+    parser.add_argument("--log-every", type=int, default=50, help="steps between metric flushes")
+    args = parser.parse_args()
+    device = select_device(args.device)
+
+    print("batch size {}, {} frames, {} on {}".format(args.batch_size, args.segment_length,
+                                                      "bf16 supported" if bf16_supported(device) else "no bf16",
+                                                      device))
+    baseline = None
+    for name in args.configs:
+        if CONFIGS[name]["bf16"] and not bf16_supported(device):
+            print("{:>24}: skipped, no native bfloat16 on {}".format(name, device))
+            continue
+        for metrics in args.metrics:
+            rate, threads = throughput(CONFIGS[name], args, device, metrics)
+            baseline = baseline or rate
+            label = name if len(args.metrics) == 1 else "{} ({})".format(name, metrics)
+            print("{:>24}: {:8.2f} samples/sec   {:.2f}x   ({} threads)".format(label, rate, rate/baseline, threads))
+
+
+if __name__ == "__main__":
+    main()
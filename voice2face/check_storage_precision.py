@@ -0,0 +1,70 @@
+"""
+    Accuracy check of a reduced precision spectrogram store
+
+    Runs the VGGVox embedding network on the same crops read from a float32
+    store and from its float16/uint8 conversion (`pack_data.py convert`) and
+    reports how far the embeddings move.
+
+    $ python check_storage_precision.py packed/spectrograms packed/spectrograms_u8 --weights speaker_id_weights.pth
+"""
+import os
+import argparse
+import numpy as np
+import torch
+from networks import VGGVoxWrapper
+from storage import SpectrogramShards
+
+
+def store_bytes(store):
+    return sum(os.path.getsize(os.path.join(store.store_dir, name)) for name in store.meta["shards"])
+
+
+def read_crops(store, positions, segment_length):
+    batch = np.zeros((len(positions), store.n_bins, segment_length), dtype=np.float32)
+    for i, k in enumerate(positions):
+        end = min(store.length[k], segment_length)
+        batch[i, :, :end] = store.read(k, 0, end)
+    return torch.from_numpy(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("reference_store", help="float32 spectrogram store")
+    parser.add_argument("store", help="store to compare against the reference")
+    parser.add_argument("--weights", default=None, help="VGGVoxWrapper weights, random weights otherwise")
+    parser.add_argument("--utterances", type=int, default=256)
+    parser.add_argument("--segment-length", type=int, default=400)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    reference = SpectrogramShards(args.reference_store)
+    store = SpectrogramShards(args.store)
+    ref_positions = np.arange(min(args.utterances, len(reference)))
+    positions = store.lookup(list(reference.paths[ref_positions]))
+
+    network = VGGVoxWrapper(reference.n_bins, 128)
+    if args.weights is not None:
+        network.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    network.eval()
+
+    max_input, max_embedding, max_relative, cosine = 0.0, 0.0, 0.0, []
+    with torch.no_grad():
+        for s in range(0, len(positions), args.batch_size):
+            x_ref = read_crops(reference, ref_positions[s:s+args.batch_size], args.segment_length)
+            x = read_crops(store, positions[s:s+args.batch_size], args.segment_length)
+            e_ref, e = network(x_ref), network(x)
+            max_input = max(max_input, (x - x_ref).abs().max().item())
+            max_embedding = max(max_embedding, (e - e_ref).abs().max().item())
+            max_relative = max(max_relative, ((e - e_ref).norm(dim=1) / e_ref.norm(dim=1).clamp(min=1e-12)).max().item())
+            cosine.append(torch.nn.functional.cosine_similarity(e, e_ref, dim=1))
+
+    print("{} utterances, {} vs {}".format(len(positions), store.meta["dtype"], reference.meta["dtype"]))
+    print("storage: {:.1f} MB vs {:.1f} MB".format(store_bytes(store)/1024**2, store_bytes(reference)/1024**2))
+    print("max spectrogram deviation: {:.6f}".format(max_input))
+    print("max embedding deviation: {:.6f}".format(max_embedding))
+    print("max relative embedding deviation: {:.6f}".format(max_relative))
+    print("min cosine similarity: {:.6f}".format(torch.cat(cosine).min().item()))
+
+
+if __name__ == "__main__":
+    main()
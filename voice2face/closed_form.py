@@ -0,0 +1,160 @@
+"""
+    Solves the last layer of the face Dictionary in closed form from cached voice embeddings
+
+    With a frozen voice network and a fixed first dictionary layer, the faces
+    are a linear function of the hidden features h = relu(linear1(embedding)),
+    so the weight W of Dictionary.linear minimizing sum ||face - W h||^2 follows
+    from the normal equations, streamed over the embedding cache once:
+
+        ridge:      W = C^T (G + ridge*I)^-1
+        orthogonal: W = U V^T where C^T = U S V^T (orthonormal columns, Procrustes)
+
+    with G = sum h h^T and C = sum h face^T.
+
+    $ python closed_form.py embedding_cache face_network.weights --method orthogonal
+"""
+import argparse
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from torch.nn.utils import parametrize
+from embedding_cache import EmbeddingCache
+from networks import Dictionary
+
+
+METHODS = ("ridge", "orthogonal")
+
+
+class NormalEquations:
+    """
+        Gram matrix of the features and their cross products with the targets,
+        accumulated in float64. Accumulators of disjoint chunks can be merged.
+    """
+
+    def __init__(self, in_dim, out_dim):
+        self.count = 0
+        self.squares = 0.0
+        self.gram = torch.zeros(in_dim, in_dim, dtype=torch.float64)
+        self.cross = torch.zeros(in_dim, out_dim, dtype=torch.float64)
+
+    def update(self, h, targets):
+        h = h.double()
+        self.gram += (h.t() @ h).cpu()
+        self.cross += (h.t() @ targets.double()).cpu()
+        self.squares += (targets.double()**2).sum().item()
+        self.count += len(h)
+
+    def merge(self, other):
+        self.gram += other.gram
+        self.cross += other.cross
+        self.squares += other.squares
+        self.count += other.count
+        return self
+
+
+def solve_ridge(equations, ridge=1e-3):
+    """
+        (out_dim, in_dim) weight minimizing the squared error plus ridge*||W||^2
+    """
+    gram = equations.gram + ridge*torch.eye(len(equations.gram), dtype=torch.float64)
+    return torch.linalg.solve(gram, equations.cross).t()
+
+
+def solve_orthogonal(equations):
+    """
+        (out_dim, in_dim) weight with orthonormal columns minimizing the squared
+        error, the polar factor of C^T (for such W, ||W h||^2 does not depend on W)
+    """
+    u, _, vh = torch.linalg.svd(equations.cross.t(), full_matrices=False)
+    return u @ vh
+
+
+def dictionary_features(face_network):
+    """
+        The input of face_network.linear for a batch of embeddings
+    """
+    return lambda embedding: face_network.relu(face_network.linear1(embedding))
+
+
+@torch.no_grad()
+def accumulate(cache, features, out_dim, chunk_size=4096, num_threads=8):
+    """
+        Streams over the embedding cache in chunks on a thread pool (the GEMMs
+        release the GIL) and merges the per-chunk normal equations
+    """
+    k = cache.crops_per_utterance
+
+    def chunk(start):
+        rows = np.arange(start, min(start+chunk_size, len(cache)))
+        h = features(torch.from_numpy(np.array(cache.embeddings[rows])))
+        equations = NormalEquations(h.shape[1], out_dim)
+        equations.update(h, torch.from_numpy(cache.faces[rows // k].astype(np.float32)))
+        return equations
+
+    total = None
+    with ThreadPoolExecutor(num_threads) as pool:
+        for equations in pool.map(chunk, range(0, len(cache), chunk_size)):
+            total = equations if total is None else total.merge(equations)
+    return total
+
+
+@torch.no_grad()
+def fit_dictionary(face_network, cache, method="ridge", ridge=1e-3, chunk_size=4096, num_threads=8):
+    """
+        Replaces the weight of face_network.linear with the closed-form solution,
+        in place. A parametrization of the weight (ORTHOGONALIZE="parametrization")
+        is removed first, it would be applied on top of the solution, so the
+        module and its state dict are those of a plain Dictionary afterwards.
+
+        returns the mean squared error per pixel of the weight the module uses, on the cache
+    """
+    if method not in METHODS:
+        raise ValueError("unknown solver {}, expected one of {}".format(method, METHODS))
+    device = face_network.linear1.weight.device
+    cpu_features = dictionary_features(face_network.cpu())
+    out_dim = face_network.linear.out_features
+    equations = accumulate(cache, cpu_features, out_dim, chunk_size, num_threads)
+
+    weight = solve_ridge(equations, ridge) if method == "ridge" else solve_orthogonal(equations)
+    if parametrize.is_parametrized(face_network.linear, "weight"):
+        parametrize.remove_parametrizations(face_network.linear, "weight", leave_parametrized=False)
+    face_network.linear.weight.copy_(weight.float())
+    face_network.to(device)
+
+    return mean_squared_error(equations, face_network.linear.weight.cpu())
+
+
+def mean_squared_error(equations, weight):
+    """
+        Mean squared error per output of weight on the accumulated data,
+        sum ||f - W h||^2 = sum ||f||^2 - 2 tr(W C) + tr(W G W^T)
+    """
+    w = weight.double()
+    residual = (equations.squares - 2*torch.trace(w @ equations.cross).item()
+                + torch.trace(w @ equations.gram @ w.t()).item())
+    return residual / (equations.count*w.shape[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("embedding_cache", help="directory written by the FREEZE_VOICE mode of train.py")
+    parser.add_argument("face_weights", help="output state dict of the Dictionary")
+    parser.add_argument("--init", default=None, help="Dictionary weights providing linear1, random otherwise")
+    parser.add_argument("--method", default="ridge", choices=METHODS)
+    parser.add_argument("--ridge", type=float, default=1e-3)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.embedding_cache)
+    face_network = Dictionary(cache.embeddings.shape[1], cache.faces.shape[1])
+    if args.init is not None:
+        face_network.load_state_dict(torch.load(args.init, map_location="cpu"))
+    mse = fit_dictionary(face_network, cache, args.method, args.ridge, args.chunk_size, args.threads)
+    torch.save(face_network.state_dict(), args.face_weights)
+    print("{} solution from {} embeddings, MSE {:.4f}, written to {}".format(
+        args.method, len(cache), mse, args.face_weights))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,58 +1,251 @@
 import os
 import numpy as np
+import torch
 from PIL import Image
-from random import randint
+from random import randint, sample
 from torch.utils.data import Dataset
 from collections import defaultdict
+from spectrogram_cache import SharedSpectrogramCache
+from normalization import Normalizer
+from storage import SpectrogramShards, FaceStore, Manifest, SPEAKER_LABELS, load_lengths
+
+
+def crop_starts(recording_length, segment_length, n_crops):
+    """
+        Picks n_crops distinct random start frames (repeated only when the
+        recording has fewer possible windows than n_crops)
+    """
+    if segment_length is None or recording_length <= segment_length:
+        return [0]*n_crops
+    windows = recording_length-segment_length+1
+    if n_crops == 1:
+        return [randint(0, windows-1)]
+    if windows >= n_crops:
+        return sample(range(windows), n_crops)
+    return [randint(0, windows-1) for _ in range(n_crops)]
+
+
+def collate(batch, with_lengths=False):
+    """
+        Copies the samples straight into preallocated contiguous batch tensors:
+        float32 spectrograms (zero padded to the longest sample), uint8 faces
+        and int64 labels. Returns (utterances, faces, labels[, lengths]).
+    """
+    lengths = [x.shape[1] for x, _, _ in batch]
+    utt = torch.empty(len(batch), batch[0][0].shape[0], max(lengths))
+    faces = torch.empty(len(batch), batch[0][1].size, dtype=torch.uint8)
+    y = torch.empty(len(batch), dtype=torch.int64)
+    for i, (x, face, label) in enumerate(batch):
+        utt[i, :, :x.shape[1]] = torch.from_numpy(x)
+        utt[i, :, x.shape[1]:] = 0
+        faces[i] = torch.from_numpy(face)
+        y[i] = int(label)
+    if with_lengths:
+        return utt, faces, y, torch.tensor(lengths)
+    return utt, faces, y
+
+
+def pad_collate(batch):
+    """
+        collate for variable length samples, also returns their lengths
+    """
+    return collate(batch, with_lengths=True)
 
 
 class VoxCelebVGGFace(Dataset):
     """
-        This dataloader loads VoxCeleb and VGGFace simultaneously 
+        This dataloader loads VoxCeleb and VGGFace simultaneously
+
+        dataset_file: mapping file (split,utterance,face,label per line) or a manifest
+                      compiled from it by `pack_data.py manifest`
+
+        spectrogram_store: optional directory written by `pack_data.py spectrograms`,
+                           crops are then read from its shards instead of the .npy files
+        face_store: optional directory written by `pack_data.py faces`, faces are then
+                    rows of the packed array instead of decoded images
 
+        Samples are float32 spectrograms and flattened uint8 faces, faces are
+        only converted to float on the training device. Indexing with a list of
+        indices returns a whole collated batch (see get_batch), so a DataLoader
+        with batch_size=None and a batch sampler receives ready batches from
+        its workers.
+        lengths_index: optional file written by `pack_data.py lengths`, gives the number of
+                       frames of every sample up front (a spectrogram store already has them)
+        pad: zero pad every crop to segment_length; without padding samples keep their own
+             length (full utterances if segment_length is None) and go through pad_collate
+        crops_per_utterance: get_batch emits this many distinct random crops of every
+                             utterance it loads, shuffled across the batch
+        cache_bytes: keep up to this many bytes of whole decoded spectrograms in an LRU
+                     cache shared by the DataLoader workers (0 disables it)
+        normalization: optional corpus statistics written by `pack_data.py stats`, applied
+                       per frequency bin to whole batches (padding stays zero)
     """
-    def __init__(self, dataset_file, dataset_types, segment_length=400):
+    def __init__(self, dataset_file, dataset_types, segment_length=400, spectrogram_store=None,
+                 face_store=None, lengths_index=None, pad=True, crops_per_utterance=1, cache_bytes=0,
+                 normalization=None):
         types = {"train": 1, "val": 2, "test": 3}
         self.label_types = [types[i] for i in dataset_types]
         self.segment_length = segment_length
-        self.dataset, self.labels = self.read_dataset(dataset_file)
+        self.pad = pad
+        self.crops_per_utterance = crops_per_utterance
+        if pad and segment_length is None:
+            raise ValueError("full utterances (segment_length=None) can only be used with pad=False")
+        self.manifest, self.rows, self.labels = self.read_dataset(dataset_file)
+        self.targets = self.manifest.label[self.rows].astype(np.int64)
+
+        self.spectrograms = None
+        if spectrogram_store is not None:
+            self.spectrograms = SpectrogramShards(spectrogram_store)
+            self.utt_index = self.spectrograms.lookup([self.manifest.utterance(r) for r in self.rows])
+
+        # number of frames of every sample, when known without opening the files
+        self.lengths = None
+        if self.spectrograms is not None:
+            self.lengths = self.spectrograms.length[self.utt_index]
+        elif lengths_index is not None:
+            self.lengths = load_lengths(lengths_index, [self.manifest.utterance(r) for r in self.rows])
+
+        self.faces = None
+        if face_store is not None:
+            self.faces = FaceStore(face_store)
+            self.face_index = self.faces.lookup([self.manifest.face(r) for r in self.rows])
+
+        self.normalizer = None
+        if normalization is not None:
+            self.normalizer = Normalizer(normalization)
+
+        self.cache = None
+        if cache_bytes > 0:
+            self.cache = SharedSpectrogramCache(len(self.rows), 257, cache_bytes)
 
     def __len__(self):
-        return len(self.dataset)
+        return len(self.rows)
+
+    def read_crops(self, index, n_crops=1):
+        """
+            Picks n_crops random crops of sample index and reads the utterance once,
+            only the frames spanned by the crops
+        """
+        if self.cache is not None:
+            x = self.load_cached(index)
+            length = x.shape[1]
+        elif self.spectrograms is not None:
+            length = self.lengths[index]
+        else:
+            # a memory-mapped load parses the header, slicing then reads the crops only
+            x = np.load(self.manifest.utterance(self.rows[index]), mmap_mode="r")
+            length = x.shape[1] if self.lengths is None else self.lengths[index]
+        width = length if self.segment_length is None else min(length, self.segment_length)
+        starts = crop_starts(length, self.segment_length, n_crops)
+
+        first, last = min(starts), max(starts)+width
+        if self.spectrograms is not None and self.cache is None:
+            span = self.spectrograms.read(self.utt_index[index], first, last)
+        else:
+            span = x[:, first:last]
+        return [span[:, start-first:start-first+width] for start in starts]
+
+    def load_cached(self, index):
+        """
+            Returns the whole spectrogram of sample index from the shared cache,
+            decoding and caching it on a miss
+        """
+        x = self.cache.get(index)
+        if x is None:
+            if self.spectrograms is not None:
+                x = self.spectrograms.read(self.utt_index[index], 0, self.lengths[index])
+            else:
+                x = np.load(self.manifest.utterance(self.rows[index]))
+            x = np.ascontiguousarray(x, dtype=np.float32)
+            self.cache.put(index, x)
+        return x
+
+    def read_crop(self, index):
+        """
+            Picks a random crop of sample index and reads only its frames
+        """
+        return self.read_crops(index)[0]
+
+    def read_face(self, index):
+        if self.faces is None:
+            return np.array(Image.open(self.manifest.face(self.rows[index])), np.uint8).flatten()
+        return np.array(self.faces.faces[self.face_index[index]]).reshape(-1)
+
+    def get_batch(self, indices, crops=None, faces=None):
+        """
+            Builds a collated batch in one call: the crops are read straight into
+            one preallocated tensor and the faces are gathered from the face store
+            with a single fancy index. With crops_per_utterance=K every utterance
+            contributes K samples, so the batch holds K*len(indices) samples.
+
+            crops: optional crops already read for every index (as returned by
+                   read_crops), e.g. by a ReadAheadLoader
+            faces: optional face pixels already read for every index (as
+                   returned by read_face), e.g. by a ReadAheadLoader
+
+            Returns (utterances, faces, labels), plus the lengths when pad=False
+        """
+        if crops is None:
+            crops = [self.read_crops(i, self.crops_per_utterance) for i in indices]
+        crops = [crop for utterance in crops for crop in utterance]
+        # position in indices of the utterance of every sample
+        positions = np.repeat(np.arange(len(indices)), self.crops_per_utterance)
+        if self.crops_per_utterance > 1:
+            # spread the crops of an utterance across the batch
+            order = np.random.permutation(len(crops))
+            crops = [crops[i] for i in order]
+            positions = positions[order]
+        indices = np.asarray(indices)[positions]
+
+        lengths = [x.shape[1] for x in crops]
+        width = self.segment_length if self.pad else max(lengths)
+
+        utt = torch.zeros(len(indices), 257, width)
+        buffer = utt.numpy()
+        for i, x in enumerate(crops):
+            buffer[i, :, :x.shape[1]] = x
+        if self.normalizer is not None:
+            self.normalizer(utt, lengths)
+
+        if faces is not None:
+            faces = torch.from_numpy(np.stack(faces)[positions])
+        elif self.faces is None:
+            # decode every face once, even if its utterance gave several crops
+            unique, inverse = np.unique(indices, return_inverse=True)
+            faces = torch.from_numpy(np.stack([self.read_face(i) for i in unique])[inverse])
+        else:
+            faces = torch.from_numpy(self.faces.faces[self.face_index[indices]].reshape(len(indices), -1))
+
+        y = torch.from_numpy(self.targets[indices])
+        if self.pad:
+            return utt, faces, y
+        return utt, faces, y, torch.tensor(lengths)
 
     def __getitem__(self, index):
-        split, utt, face, y = self.dataset[index]
-        # load the audio 
-        x = np.load(utt)
-        recording_length = x.shape[1]
-        new_x = np.zeros((257, self.segment_length))
-        if recording_length > self.segment_length:
-            start = randint(0, recording_length-self.segment_length)
-            end = start+self.segment_length
+        if isinstance(index, (list, np.ndarray)):
+            return self.get_batch(index)
+
+        # load the audio
+        x = self.read_crop(index)
+        if self.pad:
+            new_x = np.zeros((257, self.segment_length), dtype=np.float32)
+            new_x[:, :x.shape[1]] = x
         else:
-            start = 0
-            end = recording_length
-        new_x[:, :end-start] = x[:, start:end]
+            new_x = np.array(x, dtype=np.float32)
+        if self.normalizer is not None:
+            self.normalizer(torch.from_numpy(new_x)[None], [x.shape[1]])
 
-        
-        # load the face 
-        face_pixels = np.array(Image.open(face), np.float).flatten()
+        # load the face
+        face_pixels = self.read_face(index)
 
         # get the label for the voice ID
-        y = self.labels.index(y)
-        
+        y = self.targets[index]
+
         return new_x, face_pixels, y
 
     def read_dataset(self, dataset_file):
-        dataset = []
-        with open(dataset_file, "r") as f:
-            for l in f.readlines():
-                file_meta = l.strip().split(",")
-                file_meta[0] = int(file_meta[0])
-                if file_meta[0] not in self.label_types:
-                    continue
-                dataset.append(file_meta)
-        # generate the labels so it is consistent with the speaker ID 
-        labels = ['id'+str(10000+i) for i in range(1, 1252)]
-        return dataset, labels
+        manifest = Manifest.open(dataset_file)
+        rows = manifest.select(self.label_types)
+        # the labels are consistent with the speaker ID
+        return manifest, rows, SPEAKER_LABELS
 
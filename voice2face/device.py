@@ -0,0 +1,69 @@
+import os
+import torch
+
+
+def select_device(name=None):
+    """
+        The requested device, or cuda when available and the cpu otherwise
+    """
+    if name is not None:
+        return torch.device(name)
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def cpu_bf16_supported():
+    """
+        True if the cpu has native bfloat16 instructions (AVX512-BF16 or AMX),
+        without them oneDNN emulates bf16 and autocast is slower than float32
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def bf16_supported(device):
+    if device.type == "cuda":
+        return torch.cuda.is_bf16_supported()
+    return cpu_bf16_supported()
+
+
+def configure_cpu_threads(num_workers, num_threads=None, processes=1, worker_share=0.25):
+    """
+        Sets the intra-op threads of the training process so that together with
+        the DataLoader workers they do not oversubscribe the cores
+
+        num_workers: DataLoader workers actually started by this process
+        num_threads: explicit thread count, by default the cores of this process
+                     left after worker_share of a core per worker (the workers
+                     mostly wait on reads), the workers never taking more than
+                     half of the cores
+        processes: training processes sharing the cores of the node equally
+        returns the number of threads
+    """
+    if num_threads is None:
+        cores = (os.cpu_count() or 1) / processes
+        reserved = min(num_workers*worker_share, cores/2)
+        num_threads = max(1, int(cores - reserved))
+    torch.set_num_threads(num_threads)
+    return num_threads
+
+
+def prepare_network(network, device, channels_last=False):
+    """
+        Moves network to device, with channels-last convolution weights if asked
+        (the layout oneDNN and cudnn tensor cores run fastest on)
+    """
+    network = network.to(device)
+    if channels_last:
+        network = network.to(memory_format=torch.channels_last)
+    return network
+
+
+def autocast(device, enabled):
+    """
+        bfloat16 autocast on device, a no-op context when not enabled
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
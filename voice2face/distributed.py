@@ -0,0 +1,112 @@
+import os
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+def init_distributed(backend="gloo"):
+    """
+        Joins the process group described by the environment of torchrun
+        (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT)
+
+        returns (rank, world_size), (0, 1) for a process started on its own
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) == 1:
+        return 0, 1
+    dist.init_process_group(backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def local_processes():
+    """
+        Training processes sharing the cores of this node
+    """
+    return int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+
+
+def local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def _coalesced(tensors, op):
+    # one collective per dtype over a flat copy instead of one per tensor
+    by_dtype = {}
+    for t in tensors:
+        by_dtype.setdefault(t.dtype, []).append(t)
+    for group in by_dtype.values():
+        flat = _flatten_dense_tensors(group)
+        op(flat)
+        for t, synced in zip(group, _unflatten_dense_tensors(flat, group)):
+            t.copy_(synced)
+
+
+@torch.no_grad()
+def broadcast_state(modules, src=0):
+    """
+        Copies the parameters and buffers (e.g. batch norm statistics) of
+        modules from rank src to every rank
+    """
+    if not is_distributed():
+        return
+    tensors = [t for m in modules for t in list(m.parameters()) + list(m.buffers())]
+    _coalesced(tensors, lambda flat: dist.broadcast(flat, src))
+
+
+class GradientAllReduce:
+    """
+        Averages the gradients of parameters over the ranks, call it before
+        every optimizer step
+
+        The gradients are all-reduced in one flat buffer per dtype, so a step
+        costs one collective whatever the number of parameters. Every rank runs
+        the same graph, so the same parameters have gradients on every rank.
+    """
+
+    def __init__(self, parameters):
+        self.parameters = [p for p in parameters if p.requires_grad]
+
+    @torch.no_grad()
+    def __call__(self):
+        if not is_distributed():
+            return
+        world_size = dist.get_world_size()
+        grads = [p.grad for p in self.parameters if p.grad is not None]
+
+        def all_reduce(flat):
+            dist.all_reduce(flat)
+            flat /= world_size
+        _coalesced(grads, all_reduce)
+
+
+def any_rank(flag):
+    """
+        True on every rank if flag is set on any of them (e.g. a SIGTERM that
+        reached only some processes), so that all ranks stop at the same step
+    """
+    if not is_distributed():
+        return flag
+    flag = torch.tensor([int(flag)])
+    dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+def average(values):
+    """
+        Mean over the ranks of a dict of numbers, the same on every rank
+    """
+    if not is_distributed():
+        return values
+    names = sorted(values)
+    mean = torch.tensor([float(values[n]) for n in names], dtype=torch.float64)
+    dist.all_reduce(mean)
+    mean /= dist.get_world_size()
+    return dict(zip(names, mean.tolist()))
+
+
+def cleanup():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
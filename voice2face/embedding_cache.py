@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
+from storage import META_FILE as STORE_META_FILE
+
+
+EMBEDDINGS_FILE = "embeddings.npy"
+FACES_FILE = "faces.npy"
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+
+
+class _CropBatches:
+    """
+        Batches of crops_per_utterance crops of consecutive samples, the crops of
+        sample i are rows i*K..i*K+K-1 of the batch (get_batch would shuffle them)
+    """
+
+    def __init__(self, dataset, crops_per_utterance):
+        self.dataset = dataset
+        self.crops_per_utterance = crops_per_utterance
+
+    def __getitem__(self, indices):
+        crops = [[crop] for i in indices for crop in self.dataset.read_crops(i, self.crops_per_utterance)]
+        batch = self.dataset.get_batch(np.repeat(indices, self.crops_per_utterance), crops=crops)
+        return (np.asarray(indices),) + tuple(batch)
+
+
+def embedding_meta(dataset, weights_file, crops_per_utterance):
+    """
+        What the cached embeddings depend on, a cache is only reused when this matches:
+        the voice weights, the samples and crops, the spectrogram store the crops
+        are read from (its dtype and quantization) and the normalization statistics
+    """
+    meta = {"weights": os.path.abspath(weights_file), "weights_mtime": os.path.getmtime(weights_file),
+            "samples": len(dataset), "rows": dataset.rows.tolist(), "segment_length": dataset.segment_length,
+            "pad": dataset.pad, "crops_per_utterance": crops_per_utterance,
+            "spectrogram_store": None, "normalization": None}
+    if dataset.spectrograms is not None:
+        store = dataset.spectrograms
+        meta["spectrogram_store"] = {"path": os.path.abspath(store.store_dir), "meta": store.meta,
+                                     "mtime": os.path.getmtime(os.path.join(store.store_dir, STORE_META_FILE))}
+    if dataset.normalizer is not None:
+        stats_file = dataset.normalizer.stats_file
+        meta["normalization"] = {"path": os.path.abspath(stats_file), "mtime": os.path.getmtime(stats_file)}
+    return meta
+
+
+class EmbeddingCache:
+    """
+        Voice embeddings of a frozen encoder, K random crops per sample
+
+        embeddings: (N*K, D) float32 memmap, crop k of sample i is row i*K+k
+        faces: (N, 128*128) uint8 memmap, the face of every sample
+        labels: (N,) int64 identity of every sample
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.crops_per_utterance = self.meta["crops_per_utterance"]
+        self.embeddings = np.load(os.path.join(cache_dir, EMBEDDINGS_FILE), mmap_mode="r")
+        self.faces = np.load(os.path.join(cache_dir, FACES_FILE), mmap_mode="r")
+        self.labels = np.load(os.path.join(cache_dir, INDEX_FILE))["labels"]
+        self._table = None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @staticmethod
+    def is_complete(cache_dir, meta):
+        """
+            True if cache_dir holds a finished cache built with the same meta
+        """
+        meta_file = os.path.join(cache_dir, META_FILE)
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file) as f:
+            return json.load(f) == json.loads(json.dumps(meta))
+
+    def table(self, device):
+        """
+            The embeddings as one tensor on device, read from disk on first use only
+        """
+        if self._table is None:
+            self._table = torch.from_numpy(np.array(self.embeddings))
+        self._table = self._table.to(device)
+        return self._table
+
+    def batches(self, batch_size, device, shuffle=True, drop_last=True, seed=None, start=0):
+        """
+            Yields (embeddings, faces, labels) batches on device, the embedding
+            table is kept on the device across epochs so a batch is a single gather
+
+            seed: draws the order from this seed instead of the global numpy RNG
+            start: skips the first start batches of the order (to resume an epoch)
+        """
+        table = self.table(device)
+        rng = np.random if seed is None else np.random.RandomState(seed)
+        order = rng.permutation(len(self)) if shuffle else np.arange(len(self))
+        end = len(order) - len(order) % batch_size if drop_last else len(order)
+        for first in range(start*batch_size, end, batch_size):
+            rows = np.sort(order[first:first+batch_size])
+            samples = rows // self.crops_per_utterance
+            faces = torch.from_numpy(self.faces[samples]).to(device)
+            yield table[torch.from_numpy(rows).to(device)], faces, torch.from_numpy(self.labels[samples])
+
+
+@torch.no_grad()
+def build_embedding_cache(dataset, voice_network, cache_dir, meta, crops_per_utterance=10, batch_size=64,
+                          device="cuda", num_workers=8):
+    """
+        Runs the frozen voice network once over crops_per_utterance random crops
+        of every sample of dataset and writes the embeddings, the faces and the
+        labels to cache_dir. The meta file is written last, so an interrupted
+        build is never mistaken for a finished cache.
+
+        dataset: a VoxCelebVGGFace with crops_per_utterance=1
+        meta: embedding_meta of the dataset and the voice network weights
+        returns the EmbeddingCache
+    """
+    if dataset.crops_per_utterance != 1:
+        raise ValueError("the embedding cache draws its own crops, build it from a dataset with crops_per_utterance=1")
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    meta_file = os.path.join(cache_dir, META_FILE)
+    if os.path.isfile(meta_file):
+        os.remove(meta_file)
+
+    voice_network.eval()
+    n, k = len(dataset), crops_per_utterance
+    embeddings = faces = None
+    sampler = BatchSampler(SequentialSampler(range(n)), max(1, batch_size // k), drop_last=False)
+    loader = DataLoader(_CropBatches(dataset, k), batch_size=None, sampler=sampler, num_workers=num_workers)
+    for batch in loader:
+        indices, utt, face, y = batch[:4]
+        lengths = batch[4] if len(batch) > 4 else None
+        embedding = voice_network(utt.to(device), lengths=lengths).cpu().numpy()
+        if embeddings is None:
+            embeddings = np.lib.format.open_memmap(os.path.join(cache_dir, EMBEDDINGS_FILE), mode="w+",
+                                                   dtype=np.float32, shape=(n*k, embedding.shape[1]))
+            faces = np.lib.format.open_memmap(os.path.join(cache_dir, FACES_FILE), mode="w+",
+                                              dtype=np.uint8, shape=(n, face.shape[1]))
+        indices = indices.numpy()
+        embeddings[indices[0]*k:(indices[-1]+1)*k] = embedding
+        faces[indices] = face.numpy()[::k]
+    embeddings.flush()
+    faces.flush()
+    del embeddings, faces
+
+    np.savez(os.path.join(cache_dir, INDEX_FILE), labels=dataset.targets)
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+    return EmbeddingCache(cache_dir)
+
+
+def open_embedding_cache(dataset, voice_network, cache_dir, weights_file, crops_per_utterance=10, **kwargs):
+    """
+        Returns the EmbeddingCache in cache_dir, building it first if it is
+        missing or was computed for other samples, crops or weights
+    """
+    meta = embedding_meta(dataset, weights_file, crops_per_utterance)
+    if EmbeddingCache.is_complete(cache_dir, meta):
+        return EmbeddingCache(cache_dir)
+    print("Computing {} voice embeddings into {}".format(len(dataset)*crops_per_utterance, cache_dir))
+    return build_embedding_cache(dataset, voice_network, cache_dir, meta, crops_per_utterance, **kwargs)
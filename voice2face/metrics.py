@@ -0,0 +1,51 @@
+import torch
+
+
+class RunningMetrics:
+    """
+        Running sums of scalar training metrics kept as one tensor on the device
+
+        add() only queues an on-device addition, the values are copied to the
+        host (one synchronization for all metrics) when flush() or means() is
+        called, e.g. every flush_every steps and at the end of the epoch.
+
+        names: metric names, in the order of the values passed to add
+        flush_every: steps between two flushes, see due()
+    """
+
+    def __init__(self, names, device, flush_every=50):
+        self.names = list(names)
+        self.flush_every = flush_every
+        self.sums = torch.zeros(len(self.names), device=device)
+        self.window = torch.zeros(len(self.names), device=device)
+        self.steps = 0
+        self.window_steps = 0
+
+    def add(self, *values):
+        values = torch.stack([v.detach().float() for v in values])
+        self.sums += values
+        self.window += values
+        self.steps += 1
+        self.window_steps += 1
+
+    def due(self):
+        return self.window_steps >= self.flush_every
+
+    def flush(self):
+        """
+            Means since the last flush as a dict, then starts a new window
+        """
+        means = self._means(self.window, self.window_steps)
+        self.window.zero_()
+        self.window_steps = 0
+        return means
+
+    def means(self):
+        """
+            Means since the metrics were created
+        """
+        return self._means(self.sums, self.steps)
+
+    def _means(self, sums, steps):
+        values = (sums / max(steps, 1)).tolist()
+        return dict(zip(self.names, values))
@@ -1,8 +1,35 @@
+import torch
 from torch import no_grad
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _time(v):
+    # the time axis entry of a (freq, time) layer argument
+    return v[1] if isinstance(v, tuple) else v
+
+
+def output_frames(layers, lengths):
+    """
+        Number of time frames left after layers for inputs of the given lengths
+    """
+    for layer in layers:
+        if isinstance(layer, (nn.Conv2d, nn.MaxPool2d)):
+            kernel, stride = _time(layer.kernel_size), _time(layer.stride)
+            padding, dilation = _time(layer.padding), _time(layer.dilation)
+            lengths = (lengths + 2*padding - dilation*(kernel-1) - 1) // stride + 1
+    return lengths.clamp(min=1)
+
+
+def masked_avg_pool(x, lengths):
+    """
+        Averages x (N, C, 1, T) over the first lengths[n] frames of every sample
+    """
+    mask = torch.arange(x.size(3), device=x.device)[None, :] < lengths[:, None]
+    mask = mask[:, None, None, :].to(x.dtype)
+    return (x * mask).sum(dim=3, keepdim=True) / lengths[:, None, None, None].to(x.dtype)
+
+
 class VGGVox(nn.Module):
     def __init__(self, input_dim, embed_dim, num_classes=1251):
         super().__init__()
@@ -34,10 +61,20 @@ class VGGVox(nn.Module):
             nn.Linear(512, num_classes, bias=True)
         )
 
-    def forward(self, x, embedding=False):
+    def pool(self, x, lengths=None):
+        """
+            Temporal average pooling, restricted to the real frames when the
+            lengths of the (zero padded) inputs are given
+        """
+        if lengths is None:
+            return F.avg_pool2d(x, (1, x.size()[3]), stride=1)
+        lengths = output_frames(self.model, lengths.to(x.device))
+        return masked_avg_pool(x, lengths.clamp(max=x.size(3)))
+
+    def forward(self, x, embedding=False, lengths=None):
         x = x[:,None,:,:]
         x = self.model(x)
-        x = F.avg_pool2d(x, (1, x.size()[3]), stride=1)
+        x = self.pool(x, lengths)
         x = x.view(x.size()[0], -1)
         if embedding:
             return x
@@ -47,14 +84,14 @@ class VGGVoxWrapper(VGGVox):
     def __init__(self, input_dim, embed_dim, num_classes=1251):
         super().__init__(input_dim, embed_dim, num_classes=1251)
 
-    def forward(self, x, loss=False):
+    def forward(self, x, loss=False, lengths=None):
         if loss:
             # with no_grad():
             return self.dense(x)
 
         x = x[:,None,:,:]
         x = self.model(x)
-        x = F.avg_pool2d(x, (1, x.size()[3]), stride=1)
+        x = self.pool(x, lengths)
         x = x.view(x.size()[0], -1)
         return x
 
@@ -0,0 +1,102 @@
+import numpy as np
+import torch
+from multiprocessing import Pool
+from storage import SpectrogramShards
+
+
+class BinStats:
+    """
+        Streaming per-frequency-bin mean and variance (Welford/Chan)
+
+        Accumulators over disjoint sets of frames can be merged exactly, so the
+        corpus can be split across processes and reduced at the end.
+    """
+
+    def __init__(self, n_bins):
+        self.count = 0
+        self.mean = np.zeros(n_bins)
+        self.m2 = np.zeros(n_bins)
+
+    def update(self, x):
+        """
+            Adds the frames of the (n_bins, frames) spectrogram x
+        """
+        batch = BinStats(len(self.mean))
+        batch.count = x.shape[1]
+        if batch.count == 0:
+            return
+        x = np.asarray(x, dtype=np.float64)
+        batch.mean = x.mean(axis=1)
+        batch.m2 = ((x - batch.mean[:, None])**2).sum(axis=1)
+        self.merge(batch)
+
+    def merge(self, other):
+        count = self.count + other.count
+        if count == 0:
+            return self
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.count/count
+        self.m2 = self.m2 + other.m2 + delta**2*self.count*other.count/count
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+    def save(self, stats_file):
+        np.savez(stats_file, count=self.count, mean=self.mean, variance=self.variance)
+
+
+def _chunk_stats(job):
+    store_dir, items = job
+    store = SpectrogramShards(store_dir) if store_dir is not None else None
+    stats = None
+    for item in items:
+        if store is not None:
+            x = store.read(item, 0, store.length[item])
+        else:
+            x = np.load(item, mmap_mode="r")
+        if stats is None:
+            stats = BinStats(x.shape[0])
+        stats.update(x)
+    return stats
+
+
+def corpus_stats(utterances, store_dir=None, num_workers=None, chunk_size=256):
+    """
+        Per-bin mean and variance over every frame of every utterance, in one
+        streaming pass split across a process pool
+
+        utterances: .npy paths, or positions in the store when store_dir is given
+    """
+    jobs = [(store_dir, utterances[i:i+chunk_size]) for i in range(0, len(utterances), chunk_size)]
+    total = None
+    with Pool(num_workers) as pool:
+        for stats in pool.imap_unordered(_chunk_stats, jobs):
+            if stats is None:
+                continue
+            total = stats if total is None else total.merge(stats)
+    return total
+
+
+class Normalizer:
+    """
+        Applies corpus statistics to a whole (N, n_bins, frames) batch at once,
+        keeping the zero padding after lengths[n] frames at zero
+
+        stats_file: file written by BinStats.save
+    """
+
+    def __init__(self, stats_file, eps=1e-5):
+        self.stats_file = stats_file
+        stats = np.load(stats_file)
+        self.mean = torch.from_numpy(stats["mean"].astype(np.float32))[:, None]
+        self.inv_std = torch.from_numpy(1/np.sqrt(stats["variance"] + eps).astype(np.float32))[:, None]
+
+    def __call__(self, batch, lengths=None):
+        batch.sub_(self.mean).mul_(self.inv_std)
+        if lengths is not None:
+            for i, length in enumerate(lengths):
+                batch[i, :, length:] = 0
+        return batch
@@ -0,0 +1,144 @@
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.utils import parametrize
+
+
+METHODS = ("gram_schmidt", "qr", "parametrization")
+
+
+# source: https://github.com/legendongary/pytorch-gram-schmidt
+def gram_schmidt(vv):
+    """
+        Reference implementation, one tiny tensor op per pair of columns
+    """
+    def projection(u, v):
+        return (v * u).sum() / (u * u).sum() * u
+
+    nk = vv.size(1) # debugged from original repo
+    uu = torch.zeros_like(vv, device=vv.device)
+    uu[:, 0] = vv[:, 0].clone() # copy first column
+    for k in range(1, nk):
+        vk = vv[:, k].clone() # debugged from original repo
+        uk = 0
+        for j in range(0, k): # project vk onto space spanned by bases so far
+            uj = uu[:, j].clone()
+            uk = uk + projection(uj, vk)
+        uu[:, k] = vk - uk
+    for k in range(nk):
+        uk = uu[:, k].clone()
+        uu[:, k] = uk / uk.norm()
+    return uu
+
+
+def qr_orthonormalize(vv):
+    """
+        Orthonormalizes the columns of vv with one Householder QR
+
+        The signs of the columns are fixed so that diag(R) is positive, which
+        makes the result the one gram_schmidt computes (up to rounding; QR is
+        the more accurate of the two when vv is badly conditioned).
+    """
+    q, r = torch.linalg.qr(vv)
+    signs = torch.sign(torch.diagonal(r))
+    signs[signs == 0] = 1
+    return q * signs
+
+
+class QROrthogonal(nn.Module):
+    """
+        Parametrization returning the orthonormalized columns of its input
+
+        The gradient flows through the QR decomposition, so the weight seen by
+        the forward pass is orthonormal after every optimizer step. This is
+        far cheaper than torch's Householder parametrization for the tall
+        dictionary matrix.
+    """
+
+    def forward(self, x):
+        return qr_orthonormalize(x)
+
+    def right_inverse(self, x):
+        return x
+
+
+class Orthogonalizer:
+    """
+        Keeps the columns of a weight matrix orthonormal during training
+
+        method: "qr" re-orthonormalizes the weight after the optimizer step,
+                "gram_schmidt" does the same with the reference implementation,
+                "parametrization" makes the weight orthogonal by construction
+                (the optimizer then updates the underlying parameter and step()
+                has nothing to do). Apply it before building the optimizer,
+                and save the network with plain_state_dict.
+        every: re-orthonormalize only every this many calls to step()
+        broadcast: in a distributed run, copy the orthonormalized weight of
+                   rank 0 to the other ranks, so that they cannot drift apart
+                   through rounding differences of the factorization
+    """
+
+    def __init__(self, module, name="weight", method="qr", every=1, broadcast=False):
+        if method not in METHODS:
+            raise ValueError("unknown orthogonalization method {}, expected one of {}".format(method, METHODS))
+        self.module = module
+        self.name = name
+        self.method = method
+        self.every = every
+        self.broadcast = broadcast
+        self.steps = 0
+        if method == "parametrization":
+            parametrize.register_parametrization(module, name, QROrthogonal())
+
+    @property
+    def weight(self):
+        return getattr(self.module, self.name)
+
+    @torch.no_grad()
+    def orthogonalize(self):
+        if self.method == "parametrization":
+            return
+        weight = self.weight
+        if self.method == "qr":
+            weight.copy_(qr_orthonormalize(weight))
+        else:
+            weight.copy_(gram_schmidt(weight))
+        if self.broadcast and dist.is_available() and dist.is_initialized():
+            dist.broadcast(weight, 0)
+
+    def step(self):
+        """
+            Call after every optimizer step
+        """
+        self.steps += 1
+        if self.steps % self.every == 0:
+            self.orthogonalize()
+
+
+@torch.no_grad()
+def plain_state_dict(network):
+    """
+        State dict of network with every parametrized tensor stored under its
+        own name with the value the forward pass uses (linear.weight = QR(W)),
+        instead of the raw parametrizations.weight.original, so it loads into
+        the module without the parametrization
+    """
+    state = network.state_dict()
+    for prefix, module in network.named_modules():
+        if not parametrize.is_parametrized(module):
+            continue
+        prefix = prefix + "." if prefix else ""
+        for name in module.parametrizations:
+            raw = prefix + "parametrizations." + name + "."
+            for key in [k for k in state if k.startswith(raw)]:
+                del state[key]
+            state[prefix + name] = getattr(module, name).detach()
+    return state
+
+
+def orthogonality_error(vv):
+    """
+        max |V^T V - I|, 0 for orthonormal columns
+    """
+    gram = vv.t() @ vv
+    return (gram - torch.eye(gram.shape[0], dtype=vv.dtype, device=vv.device)).abs().max().item()
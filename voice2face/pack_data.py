@@ -0,0 +1,106 @@
+"""
+    One-time packing of the VoxCeleb/VGGFace data referenced by a dataset mapping file
+
+    $ python pack_data.py spectrograms vgg_voxceleb_edge_preserving.txt packed/spectrograms
+    $ python pack_data.py faces vgg_voxceleb_edge_preserving.txt packed/faces
+    $ python pack_data.py manifest vgg_voxceleb_edge_preserving.txt packed/manifest.npz
+    $ python pack_data.py lengths vgg_voxceleb_edge_preserving.txt packed/lengths.npz
+    $ python pack_data.py convert packed/spectrograms packed/spectrograms_u8 --dtype uint8
+    $ python pack_data.py stats vgg_voxceleb_edge_preserving.txt packed/stats.npz --spectrogram-store packed/spectrograms
+"""
+import argparse
+from storage import read_mapping, pack_spectrograms, pack_faces, index_lengths, Manifest, SpectrogramShards
+from storage import LAYOUTS, DTYPES, SCALES
+from normalization import corpus_stats
+
+
+def unique(items):
+    return list(dict.fromkeys(items))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the files of a dataset mapping into large binary stores")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    spec = commands.add_parser("spectrograms", help="pack utterance spectrograms into memory-mapped shards")
+    spec.add_argument("dataset_mapping")
+    spec.add_argument("store_dir")
+    spec.add_argument("--shard-gb", type=float, default=4.0)
+    spec.add_argument("--threads", type=int, default=16)
+    spec.add_argument("--layout", choices=LAYOUTS, default="frames",
+                      help="frames: a crop reads one contiguous range (default)")
+    spec.add_argument("--dtype", choices=DTYPES, default="float32", help="storage precision")
+    spec.add_argument("--scale", choices=SCALES, default="bin", help="uint8 scale/offset per utterance or per bin")
+
+    convert = commands.add_parser("convert", help="rewrite a spectrogram store with another precision or layout")
+    convert.add_argument("source_dir")
+    convert.add_argument("store_dir")
+    convert.add_argument("--shard-gb", type=float, default=4.0)
+    convert.add_argument("--layout", choices=LAYOUTS, default="frames")
+    convert.add_argument("--dtype", choices=DTYPES, default="float16")
+    convert.add_argument("--scale", choices=SCALES, default="bin")
+
+    faces = commands.add_parser("faces", help="decode every face once into a uint8 memory-mapped array")
+    faces.add_argument("dataset_mapping")
+    faces.add_argument("store_dir")
+    faces.add_argument("--threads", type=int, default=16)
+
+    manifest = commands.add_parser("manifest", help="compile the mapping file into numpy columns")
+    manifest.add_argument("dataset_mapping")
+    manifest.add_argument("manifest_file")
+
+    lengths = commands.add_parser("lengths", help="index the number of frames of every utterance")
+    lengths.add_argument("dataset_mapping")
+    lengths.add_argument("lengths_file")
+    lengths.add_argument("--threads", type=int, default=16)
+
+    stats = commands.add_parser("stats", help="per-frequency-bin mean and variance over the corpus")
+    stats.add_argument("dataset_mapping")
+    stats.add_argument("stats_file")
+    stats.add_argument("--spectrogram-store", default=None, help="read the utterances from this store")
+    stats.add_argument("--splits", nargs="+", type=int, default=[1], help="split codes to include (1=train)")
+    stats.add_argument("--workers", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "convert":
+        source = SpectrogramShards(args.source_dir)
+        position = {p: i for i, p in enumerate(source.paths)}
+        load = lambda p: source.read(position[p], 0, source.length[position[p]])
+        print("converting {} utterances into {} {}".format(len(source), args.dtype, args.store_dir))
+        pack_spectrograms(list(source.paths), args.store_dir, shard_bytes=int(args.shard_gb*1024**3),
+                          num_threads=1, layout=args.layout, dtype=args.dtype, scale=args.scale, load=load)
+        return
+    rows = read_mapping(args.dataset_mapping)
+
+    if args.command == "spectrograms":
+        utterances = unique(row[1] for row in rows)
+        print("packing {} utterances into {}".format(len(utterances), args.store_dir))
+        pack_spectrograms(utterances, args.store_dir, shard_bytes=int(args.shard_gb*1024**3),
+                          num_threads=args.threads, layout=args.layout, dtype=args.dtype, scale=args.scale)
+    elif args.command == "faces":
+        # one face per image path, labelled with the identity of its first row
+        face_labels = {}
+        for row in rows:
+            face_labels.setdefault(row[2], row[3])
+        print("packing {} faces into {}".format(len(face_labels), args.store_dir))
+        pack_faces(list(face_labels), list(face_labels.values()), args.store_dir, num_threads=args.threads)
+    elif args.command == "manifest":
+        Manifest.from_rows(rows).save(args.manifest_file)
+        print("compiled {} rows into {}".format(len(rows), args.manifest_file))
+    elif args.command == "lengths":
+        utterances = unique(row[1] for row in rows)
+        lengths = index_lengths(utterances, args.lengths_file, num_threads=args.threads)
+        print("indexed {} utterances, {} frames in total".format(len(utterances), lengths.sum()))
+    elif args.command == "stats":
+        utterances = unique(row[1] for row in rows if row[0] in args.splits)
+        if args.spectrogram_store is not None:
+            utterances = SpectrogramShards(args.spectrogram_store).lookup(utterances)
+        result = corpus_stats(utterances, args.spectrogram_store, num_workers=args.workers)
+        result.save(args.stats_file)
+        print("statistics of {} frames from {} utterances written to {}".format(
+            result.count, len(utterances), args.stats_file))
+
+
+if __name__ == "__main__":
+    main()
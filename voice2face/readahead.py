@@ -0,0 +1,126 @@
+import time
+import threading
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReadAheadLoader:
+    """
+        Reads the utterances of the upcoming batches ahead of consumption
+
+        On a network share the latency of every read, not the bandwidth, limits
+        throughput. The loader walks the batch sampler up to depth batches
+        ahead and issues the crop reads and the face reads of all of them
+        concurrently on a thread pool (file reads release the GIL), then hands
+        the completed crops and faces to dataset.get_batch in sampler order.
+
+        dataset: VoxCelebVGGFace (anything with read_crops, read_face and get_batch)
+        batch_sampler: yields lists of dataset indices
+        depth: number of batches queued ahead of the one being consumed
+        num_threads: maximum number of concurrent reads (a crop read and a face
+                     read per sample)
+        stats(): queue depth, batches already read ahead and reads in flight
+                 (mean and max of samples taken at every consumed batch of the
+                 epoch) and consumer wait time, to tune depth/num_threads against
+                 the latency of the share: batches ready ahead near 0 and long
+                 waits ask for more depth or threads
+    """
+
+    def __init__(self, dataset, batch_sampler, depth=8, num_threads=32):
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.sampler = None
+        self.depth = depth
+        self.num_threads = num_threads
+
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def reset_stats(self):
+        with self._lock:
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.reads = 0
+            self.batches = 0
+            self.wait_time = 0.0
+            # sums and maxima of the samples taken when a batch is consumed
+            self.samples = {"QUEUE DEPTH": [0, 0], "BATCHES READY AHEAD": [0, 0], "READS IN FLIGHT": [0, 0]}
+
+    def stats(self):
+        with self._lock:
+            stats = {}
+            for name, (total, peak) in self.samples.items():
+                stats["AVG " + name] = total/max(self.batches, 1)
+                stats["MAX " + name] = peak
+            stats["MAX READS IN FLIGHT"] = max(stats["MAX READS IN FLIGHT"], self.max_in_flight)
+            stats["READS"] = self.reads
+            stats["AVG WAIT (ms)"] = 1000*self.wait_time/max(self.batches, 1)
+            return stats
+
+    def _sample(self):
+        # state of the read-ahead queue when the consumer takes a batch, under the lock
+        ready = sum(all(future.done() for future in crops + faces) for _, crops, faces in self._pending)
+        for name, value in (("QUEUE DEPTH", len(self._pending)), ("BATCHES READY AHEAD", ready),
+                            ("READS IN FLIGHT", self.in_flight)):
+            self.samples[name][0] += value
+            self.samples[name][1] = max(self.samples[name][1], value)
+
+    def _done(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.reads += 1
+
+    def _read(self, index):
+        try:
+            # copy so the bytes are read here rather than when the batch is built
+            return [np.array(crop) for crop in self.dataset.read_crops(index, self.dataset.crops_per_utterance)]
+        finally:
+            self._done()
+
+    def _read_face(self, index):
+        try:
+            # decoded image, or a copy of the face store row (its page faults happen here)
+            return self.dataset.read_face(index)
+        finally:
+            self._done()
+
+    def _submit(self, pool, batches):
+        batch = next(batches, None)
+        if batch is None:
+            return
+        with self._lock:
+            self.in_flight += 2*len(batch)
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self._pending.append((batch, [pool.submit(self._read, i) for i in batch],
+                              [pool.submit(self._read_face, i) for i in batch]))
+
+    def __iter__(self):
+        self.reset_stats()
+        batches = iter(self.batch_sampler)
+        with ThreadPoolExecutor(self.num_threads) as pool:
+            try:
+                for _ in range(self.depth+1):
+                    self._submit(pool, batches)
+                while self._pending:
+                    batch, crop_futures, face_futures = self._pending.popleft()
+                    # keep depth batches queued behind the one being consumed
+                    self._submit(pool, batches)
+                    start = time.time()
+                    crops = [future.result() for future in crop_futures]
+                    faces = [future.result() for future in face_futures]
+                    with self._lock:
+                        self.wait_time += time.time() - start
+                        self.batches += 1
+                        self._sample()
+                    yield self.dataset.get_batch(batch, crops, faces)
+            finally:
+                # an abandoned epoch should not leave reads queued on the pool
+                for _, crop_futures, face_futures in self._pending:
+                    for future in crop_futures + face_futures:
+                        future.cancel()
+                self._pending.clear()
@@ -0,0 +1,126 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+        Batches samples of similar length together
+
+        The shuffled dataset is cut into pools of pool_batches batches, each
+        pool is sorted by length and split into batches, and the batches are
+        shuffled again. Batches then need little padding while the order stays
+        random from epoch to epoch.
+
+        lengths: number of frames of every sample
+        max_frames: samples longer than this are cropped by the dataset
+        padding_waste(): share of padded frames in the batches of the last epoch
+    """
+
+    def __init__(self, lengths, batch_size, max_frames=None, shuffle=True, drop_last=False, pool_batches=50):
+        self.lengths = np.asarray(lengths)
+        if max_frames is not None:
+            self.lengths = np.minimum(self.lengths, max_frames)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.pool_size = batch_size*pool_batches
+        self.real_frames = 0
+        self.padded_frames = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def batches(self):
+        n = len(self.lengths)
+        indices = np.random.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for s in range(0, n, self.pool_size):
+            pool = indices[s:s+self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind="stable")]
+            batches += [pool[i:i+self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        if self.drop_last:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        self.real_frames = 0
+        self.padded_frames = 0
+        for batch in self.batches():
+            lengths = self.lengths[batch]
+            self.real_frames += int(lengths.sum())
+            self.padded_frames += len(batch)*int(lengths.max())
+            yield batch.tolist()
+
+    def padding_waste(self):
+        if self.padded_frames == 0:
+            return 0.0
+        return 1.0 - self.real_frames/self.padded_frames
+
+
+def fixed_padding_waste(lengths, segment_length):
+    """
+        Share of padded frames when every sample is padded/cropped to segment_length
+    """
+    lengths = np.minimum(np.asarray(lengths), segment_length)
+    return 1.0 - lengths.sum()/(len(lengths)*segment_length)
+
+
+class ResumableBatchSampler(Sampler):
+    """
+        Makes the batch order of any batch sampler a function of (seed, epoch)
+        so that an interrupted epoch can be replayed and resumed
+
+        The wrapped sampler draws its order from the global torch/numpy RNGs,
+        which are seeded with seed+epoch while the order of the epoch is drawn
+        and restored afterwards.
+
+        set_epoch(epoch, start=0): the next iteration yields the batches of
+        epoch, skipping the first start of them
+
+        num_replicas, rank: for distributed training, every rank draws the same
+        order and takes every num_replicas-th batch from its rank on (the same
+        number of batches on every rank, the remainder is dropped). start then
+        counts the batches of this rank.
+    """
+
+    def __init__(self, batch_sampler, seed=0, num_replicas=1, rank=0):
+        self.batch_sampler = batch_sampler
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def __len__(self):
+        return len(self.batch_sampler) // self.num_replicas
+
+    def __getattr__(self, name):
+        # padding_waste() etc. of the wrapped sampler
+        if name == "batch_sampler":
+            raise AttributeError(name)
+        return getattr(self.batch_sampler, name)
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def epoch_batches(self):
+        with torch.random.fork_rng(devices=[]):
+            numpy_state = np.random.get_state()
+            torch.manual_seed(self.seed + self.epoch)
+            np.random.seed((self.seed + self.epoch) % 2**32)
+            try:
+                batches = [list(batch) for batch in self.batch_sampler]
+            finally:
+                np.random.set_state(numpy_state)
+        return batches[self.rank:len(self)*self.num_replicas:self.num_replicas]
+
+    def __iter__(self):
+        batches = self.epoch_batches()
+        start, self.start = self.start, 0
+        return iter(batches[start:])
@@ -0,0 +1,210 @@
+import os
+import json
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+
+class Sink:
+    """
+        Destination of training metrics, called from the BackgroundLogger thread only
+
+        log: metrics is a dict of numbers, images a dict of name -> (H, W) array
+             of pixel values (converted to uint8 by the sink)
+    """
+
+    def config(self, config):
+        pass
+
+    def log(self, metrics, images):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def to_image(pixels):
+    return Image.fromarray(np.asarray(pixels).astype(np.uint8))
+
+
+class JsonlSink(Sink):
+    """
+        Offline store: one JSON line per record in out_dir/metrics.jsonl and the
+        images as out_dir/images/{name}_{n}.png, referenced from their record
+
+        A resumed run appends to metrics.jsonl and numbers its records after
+        the existing lines, so the images of earlier records are kept
+    """
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.image_dir = os.path.join(out_dir, "images")
+        os.makedirs(self.image_dir, exist_ok=True)
+        metrics_file = os.path.join(out_dir, "metrics.jsonl")
+        self.n_records = 0
+        if os.path.isfile(metrics_file):
+            with open(metrics_file) as f:
+                self.n_records = sum(1 for _ in f)
+        self.file = open(metrics_file, "a")
+
+    def config(self, config):
+        with open(os.path.join(self.out_dir, "config.json"), "w") as f:
+            json.dump(config, f, sort_keys=True, indent=4, default=str)
+
+    def log(self, metrics, images):
+        record = dict(metrics)
+        for name, pixels in images.items():
+            path = os.path.join(self.image_dir, "{}_{}.png".format(name, self.n_records))
+            to_image(pixels).save(path)
+            record[name] = os.path.relpath(path, self.out_dir)
+        self.file.write(json.dumps(record, default=float) + "\n")
+        self.file.flush()
+        self.n_records += 1
+
+    def close(self):
+        self.file.close()
+
+
+class WandbSink(Sink):
+    """
+        Weights & Biases run, initialized by the logging thread on first use
+    """
+
+    def __init__(self, project="v2f"):
+        self.project = project
+        self.run = None
+
+    def _init(self):
+        if self.run is None:
+            import wandb
+            self.wandb = wandb
+            self.run = wandb.init(project=self.project)
+
+    def config(self, config):
+        self._init()
+        self.wandb.config.update(config)
+
+    def log(self, metrics, images):
+        self._init()
+        record = dict(metrics)
+        for name, pixels in images.items():
+            record[name] = [self.wandb.Image(to_image(pixels))]
+        self.wandb.log(record)
+
+    def close(self):
+        if self.run is not None:
+            self.run.finish()
+
+
+SINKS = ("jsonl", "wandb")
+
+_STOP = object()
+
+
+class BackgroundLogger:
+    """
+        Hands metrics to the sinks through a bounded queue served by one thread,
+        so logging never blocks the training loop
+
+        When the queue is full, a record is merged into a single pending record
+        (later values of a metric overwrite earlier ones) that the thread writes
+        once it has caught up. The number of records that went through the
+        pending record is reported in it as "COALESCED RECORDS".
+
+        sinks: list of Sink
+        max_queue: records waiting for the thread before they are coalesced
+    """
+
+    def __init__(self, sinks, max_queue=256):
+        self.sinks = sinks
+        self.queue = queue.Queue(max_queue)
+        self.pending = None
+        self.coalesced = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def config(self, config):
+        self._put(("config", dict(config), None))
+
+    def log(self, metrics, images=None):
+        """
+            metrics: dict of numbers
+            images: optional dict of name -> (H, W) array on the host
+        """
+        self._put(("log", dict(metrics), dict(images or {})))
+
+    def _put(self, record):
+        if record[0] == "config":
+            # rare and never merged into metrics
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                if self.pending is None:
+                    self.pending = record
+                else:
+                    self.pending[1].update(record[1])
+                    self.pending[2].update(record[2])
+                self.coalesced += 1
+
+    def _take_pending(self):
+        with self.lock:
+            record, self.pending = self.pending, None
+            if record is not None:
+                record[1]["COALESCED RECORDS"] = self.coalesced
+                self.coalesced = 0
+        return record
+
+    def _write(self, record):
+        kind, metrics, images = record
+        for sink in self.sinks:
+            try:
+                if kind == "config":
+                    sink.config(metrics)
+                else:
+                    sink.log(metrics, images)
+            except Exception as e:
+                # a failing sink must not take the training down
+                print("{} failed: {}".format(type(sink).__name__, e))
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is _STOP:
+                break
+            self._write(record)
+            if self.queue.empty():
+                pending = self._take_pending()
+                if pending is not None:
+                    self._write(pending)
+        pending = self._take_pending()
+        if pending is not None:
+            self._write(pending)
+        for sink in self.sinks:
+            sink.close()
+
+    def close(self):
+        """
+            Writes out everything still queued and closes the sinks
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+
+
+def open_sinks(names, out_dir, wandb_project="v2f", max_queue=256):
+    """
+        BackgroundLogger writing to the named sinks ("jsonl" into out_dir, "wandb")
+    """
+    sinks = []
+    for name in names:
+        if name == "jsonl":
+            sinks.append(JsonlSink(out_dir))
+        elif name == "wandb":
+            sinks.append(WandbSink(wandb_project))
+        else:
+            raise ValueError("unknown sink {}, expected one of {}".format(name, list(SINKS)))
+    return BackgroundLogger(sinks, max_queue)
@@ -0,0 +1,140 @@
+import mmap
+import numpy as np
+import multiprocessing as mp
+
+
+# positions in the shared counters array
+CLOCK, FREE_HEAD, HITS, MISSES, EVICTIONS, BYTES = range(6)
+
+
+class SharedSpectrogramCache:
+    """
+        Byte-budgeted LRU cache of decoded spectrograms shared by all DataLoader workers
+
+        The cache is allocated in the main process before the workers are
+        forked, so a spectrogram decoded by any worker is served to every other
+        worker of the node. The budget is split into fixed-size slots of
+        slot_frames frames; a spectrogram occupies a chain of slots and the least
+        recently used spectrograms are evicted until a new one fits. All state
+        (slot data, chains, LRU clock and counters) lives in shared memory and
+        is guarded by one lock.
+
+        The slot data is an anonymous shared mapping, which is only inherited by
+        forked processes (the default DataLoader start method on Linux).
+
+        n_items: number of cacheable items (keys are 0..n_items-1)
+        n_bins: frequency bins of the spectrograms
+        budget_bytes: memory given to the slot data
+        slot_frames: allocation granularity, in frames
+    """
+
+    def __init__(self, n_items, n_bins, budget_bytes, slot_frames=100):
+        self.n_bins = n_bins
+        self.slot_frames = slot_frames
+        slot_bytes = n_bins*slot_frames*4
+        self.n_slots = int(budget_bytes // slot_bytes)
+        if self.n_slots == 0:
+            raise ValueError("a budget of {} bytes is smaller than one slot ({} bytes)".format(budget_bytes, slot_bytes))
+
+        # pages of an anonymous mapping are only allocated once written
+        self._buffer = mmap.mmap(-1, self.n_slots*slot_bytes)
+        self.slots = np.frombuffer(self._buffer, dtype=np.float32).reshape(self.n_slots, slot_frames, n_bins)
+
+        self.lock = mp.Lock()
+        self.head = self._shared(n_items, -1)
+        self.frames = self._shared(n_items, 0)
+        self.last_used = self._shared(n_items, 0)
+        self.next_slot = self._shared(self.n_slots, -1)
+        self.counters = self._shared(6, 0)
+        # every slot starts on the free list
+        self.next_slot[:-1] = np.arange(1, self.n_slots)
+        self.counters[FREE_HEAD] = 0
+
+    @staticmethod
+    def _shared(n, fill):
+        array = np.frombuffer(mp.RawArray("q", n), dtype=np.int64)
+        array[:] = fill
+        return array
+
+    def _chain(self, slot):
+        slots = []
+        while slot != -1:
+            slots.append(slot)
+            slot = self.next_slot[slot]
+        return slots
+
+    def _free_slots(self):
+        return self.n_slots - self.counters[BYTES] // (self.n_bins*self.slot_frames*4)
+
+    def _evict_lru(self):
+        cached = np.flatnonzero(self.head >= 0)
+        victim = cached[np.argmin(self.last_used[cached])]
+        chain = self._chain(self.head[victim])
+        # return the chain to the free list
+        self.next_slot[chain[-1]] = self.counters[FREE_HEAD]
+        self.counters[FREE_HEAD] = chain[0]
+        self.counters[BYTES] -= len(chain)*self.n_bins*self.slot_frames*4
+        self.counters[EVICTIONS] += 1
+        self.head[victim] = -1
+        self.frames[victim] = 0
+
+    def get(self, key):
+        """
+            Returns a copy of the (n_bins, frames) spectrogram cached under key, or None
+        """
+        with self.lock:
+            if self.head[key] < 0:
+                self.counters[MISSES] += 1
+                return None
+            self.counters[HITS] += 1
+            self.counters[CLOCK] += 1
+            self.last_used[key] = self.counters[CLOCK]
+            frames = self.frames[key]
+            x = np.empty((frames, self.n_bins), dtype=np.float32)
+            for i, slot in enumerate(self._chain(self.head[key])):
+                chunk = x[i*self.slot_frames:(i+1)*self.slot_frames]
+                chunk[:] = self.slots[slot, :len(chunk)]
+        return x.T
+
+    def put(self, key, x):
+        """
+            Caches the (n_bins, frames) spectrogram x under key, evicting the least
+            recently used entries if needed. Returns False if x can never fit.
+        """
+        needed = -(-x.shape[1] // self.slot_frames)
+        if needed > self.n_slots:
+            return False
+        with self.lock:
+            if self.head[key] >= 0:
+                return True
+            while self._free_slots() < needed:
+                self._evict_lru()
+            chain = []
+            for _ in range(needed):
+                slot = self.counters[FREE_HEAD]
+                self.counters[FREE_HEAD] = self.next_slot[slot]
+                chain.append(slot)
+            for i, slot in enumerate(chain):
+                chunk = x[:, i*self.slot_frames:(i+1)*self.slot_frames].T
+                self.slots[slot, :len(chunk)] = chunk
+                self.next_slot[slot] = chain[i+1] if i+1 < len(chain) else -1
+            self.head[key] = chain[0]
+            self.frames[key] = x.shape[1]
+            self.counters[CLOCK] += 1
+            self.last_used[key] = self.counters[CLOCK]
+            self.counters[BYTES] += needed*self.n_bins*self.slot_frames*4
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {"CACHE HITS": int(self.counters[HITS]),
+                    "CACHE MISSES": int(self.counters[MISSES]),
+                    "CACHE EVICTIONS": int(self.counters[EVICTIONS]),
+                    "CACHE MB": float(self.counters[BYTES])/1024**2}
+
+    def reset_stats(self):
+        """
+            Resets the hit/miss/eviction counters, e.g. at the start of an epoch
+        """
+        with self.lock:
+            self.counters[[HITS, MISSES, EVICTIONS]] = 0
@@ -0,0 +1,368 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+
+
+INDEX_FILE = "index.npz"
+META_FILE = "meta.json"
+SHARD_FILE = "shard_{:04d}.bin"
+FACES_FILE = "faces.npy"
+FACES_INDEX_FILE = "faces_index.npz"
+# "frames": utterances stored as (frames, bins) so a crop is one contiguous range
+# "bins": utterances stored as (bins, frames) like the .npy files, used by older stores
+LAYOUTS = ("frames", "bins")
+# storage precision of the spectrograms, uint8 values are dequantized as q*scale + offset
+DTYPES = ("float32", "float16", "uint8")
+# granularity of the uint8 scale/offset: one pair per utterance or one pair per bin of every utterance
+SCALES = ("file", "bin")
+
+
+def read_mapping(dataset_file):
+    """
+        Reads a dataset mapping file (split,utterance,face,label per line)
+
+        returns a list of [split, utterance, face, label] with split as an int
+    """
+    rows = []
+    with open(dataset_file, "r") as f:
+        for l in f.readlines():
+            file_meta = l.strip().split(",")
+            if len(file_meta) < 4:
+                continue
+            file_meta[0] = int(file_meta[0])
+            rows.append(file_meta)
+    return rows
+
+
+# the labels are generated so they are consistent with the speaker ID
+SPEAKER_LABELS = ['id'+str(10000+i) for i in range(1, 1252)]
+
+
+class Manifest:
+    """
+        Columnar form of a dataset mapping file
+
+        Every column is a numpy array: split code, integer label and the
+        offsets of the utterance and face paths inside one packed byte buffer.
+        There are no per-row Python objects, so forked DataLoader workers
+        share the pages instead of copying them when refcounts are touched.
+
+        split: (N,) int8, 1=train 2=val 3=test
+        label: (N,) int16, position of the identity in SPEAKER_LABELS
+        offsets: (2N+1,) int64, utterance i is paths[offsets[i]:offsets[i+1]]
+                 and face i is paths[offsets[N+i]:offsets[N+i+1]]
+        paths: (B,) uint8, utf-8 encoded paths back to back
+    """
+
+    def __init__(self, split, label, offsets, paths):
+        self.split = split
+        self.label = label
+        self.offsets = offsets
+        self.paths = paths
+
+    def __len__(self):
+        return len(self.split)
+
+    def _path(self, k):
+        return self.paths[self.offsets[k]:self.offsets[k+1]].tobytes().decode("utf-8")
+
+    def utterance(self, i):
+        return self._path(i)
+
+    def face(self, i):
+        return self._path(len(self)+i)
+
+    def select(self, splits):
+        """
+            Returns the rows whose split is one of splits
+        """
+        return np.flatnonzero(np.isin(self.split, splits))
+
+    def save(self, manifest_file):
+        np.savez(manifest_file, split=self.split, label=self.label, offsets=self.offsets, paths=self.paths)
+
+    @classmethod
+    def load(cls, manifest_file):
+        columns = np.load(manifest_file)
+        return cls(columns["split"], columns["label"], columns["offsets"], columns["paths"])
+
+    @classmethod
+    def from_rows(cls, rows, labels=SPEAKER_LABELS):
+        """
+            rows: [split, utterance, face, label] as returned by read_mapping
+        """
+        label_index = {l: i for i, l in enumerate(labels)}
+        unknown = [row[3] for row in rows if row[3] not in label_index]
+        if unknown:
+            raise ValueError("{} rows have an unknown label (e.g. {})".format(len(unknown), unknown[0]))
+
+        encoded = [row[1].encode("utf-8") for row in rows] + [row[2].encode("utf-8") for row in rows]
+        offsets = np.zeros(len(encoded)+1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        paths = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        split = np.array([row[0] for row in rows], dtype=np.int8)
+        label = np.array([label_index[row[3]] for row in rows], dtype=np.int16)
+        return cls(split, label, offsets, paths)
+
+    @classmethod
+    def open(cls, dataset_file):
+        """
+            Loads a compiled manifest (.npz) or compiles a mapping file in memory
+        """
+        if dataset_file.endswith(".npz"):
+            return cls.load(dataset_file)
+        return cls.from_rows(read_mapping(dataset_file))
+
+
+def lookup_paths(stored, paths, what, store_dir):
+    """
+        Returns the position of each of paths inside the stored path array
+    """
+    position = {p: i for i, p in enumerate(stored)}
+    missing = [p for p in paths if p not in position]
+    if missing:
+        raise KeyError("{} {} are not in the store {} (e.g. {})".format(
+            len(missing), what, store_dir, missing[0]))
+    return np.array([position[p] for p in paths], dtype=np.int64)
+
+
+class SpectrogramShards:
+    """
+        Read-only view over the spectrograms packed by pack_data.py
+
+        Every utterance is a contiguous float32 block inside one of a few large
+        shard files. The index keeps, per utterance, the shard number, the
+        element offset inside that shard and the number of frames, so a crop
+        is a slice of a memory map and no per-utterance file is ever opened.
+        In the "frames" layout only the bytes of the crop itself are touched.
+        float16 and uint8 stores are converted back to float32 on read.
+
+        store_dir: directory written by pack_spectrograms
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, META_FILE), "r") as f:
+            self.meta = json.load(f)
+        self.n_bins = self.meta["n_bins"]
+        self.layout = self.meta.get("layout", "bins")
+        self.dtype = np.dtype(self.meta.get("dtype", "float32"))
+
+        index = np.load(os.path.join(store_dir, INDEX_FILE))
+        self.paths = index["paths"]
+        self.shard = index["shard"]
+        self.offset = index["offset"]
+        self.length = index["length"]
+        if self.dtype == np.uint8:
+            # (N, 1) or (N, n_bins)
+            self.qscale = index["qscale"]
+            self.qoffset = index["qoffset"]
+
+        # memory maps are opened lazily so every DataLoader worker gets its own
+        self._shards = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def lookup(self, paths):
+        """
+            Maps utterance paths to their position in the store
+
+            paths: iterable of utterance paths as written in the mapping file
+        """
+        return lookup_paths(self.paths, paths, "utterances", self.store_dir)
+
+    def read(self, i, start, end):
+        """
+            Returns frames [start, end) of utterance i as a (n_bins, end-start) array
+        """
+        if self._shards is None:
+            self._shards = [np.memmap(os.path.join(self.store_dir, name), dtype=self.dtype, mode="r")
+                            for name in self.meta["shards"]]
+        shard = self._shards[self.shard[i]]
+        if self.layout == "frames":
+            first = self.offset[i] + start*self.n_bins
+            x = shard[first:first+(end-start)*self.n_bins].reshape(end-start, self.n_bins).T
+        else:
+            length = self.length[i]
+            block = shard[self.offset[i]:self.offset[i]+self.n_bins*length]
+            x = block.reshape(self.n_bins, length)[:, start:end]
+        if self.dtype == np.uint8:
+            return x * self.qscale[i][:, None] + self.qoffset[i][:, None]
+        if self.dtype != np.float32:
+            return x.astype(np.float32)
+        return x
+
+
+class FaceStore:
+    """
+        Read-only view over the faces packed by pack_data.py
+
+        All faces live in a single (N, 128, 128) uint8 array that is memory
+        mapped, so a sample costs a 16KB slice instead of an image decode.
+
+        store_dir: directory written by pack_faces
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = np.load(os.path.join(store_dir, FACES_INDEX_FILE))
+        self.paths = index["paths"]
+        self.labels = index["labels"]
+        self.faces = np.load(os.path.join(store_dir, FACES_FILE), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.paths)
+
+    def lookup(self, paths):
+        """
+            Maps face image paths to their row in the store
+        """
+        return lookup_paths(self.paths, paths, "faces", self.store_dir)
+
+    def by_label(self, label):
+        """
+            Returns the row of the face of identity label
+        """
+        return int(np.flatnonzero(self.labels == label)[0])
+
+
+def load_face(path):
+    return np.array(Image.open(path), np.uint8)
+
+
+def pack_faces(faces, labels, store_dir, face_shape=(128, 128), num_threads=16):
+    """
+        Decodes every face image once into a single uint8 array
+
+        faces: list of face image paths, stored under the exact same strings
+        labels: identity of each face (e.g. id10001)
+        store_dir: output directory (faces.npy and faces_index.npz)
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    out = np.lib.format.open_memmap(os.path.join(store_dir, FACES_FILE), mode="w+",
+                                    dtype=np.uint8, shape=(len(faces),)+tuple(face_shape))
+    with ThreadPoolExecutor(num_threads) as pool:
+        for i, face in enumerate(pool.map(load_face, faces)):
+            if face.shape != tuple(face_shape):
+                raise ValueError("{} has shape {}, expected {}".format(faces[i], face.shape, face_shape))
+            out[i] = face
+    out.flush()
+    del out
+
+    np.savez(os.path.join(store_dir, FACES_INDEX_FILE), paths=np.array(faces), labels=np.array(labels))
+
+
+def quantize(x, scale="file"):
+    """
+        Maps the (n_bins, frames) spectrogram x to uint8 with a linear scale/offset
+        per utterance (scale="file") or per frequency bin (scale="bin")
+
+        returns q, scale, offset with x ~= q*scale + offset
+    """
+    axis = None if scale == "file" else 1
+    low = np.min(x, axis=axis, keepdims=True).astype(np.float32)
+    step = ((np.max(x, axis=axis, keepdims=True) - low) / 255).astype(np.float32)
+    step[step == 0] = 1
+    q = np.rint((x - low) / step).clip(0, 255).astype(np.uint8)
+    return q, step.reshape(-1), low.reshape(-1)
+
+
+def pack_spectrograms(utterances, store_dir, shard_bytes=4*1024**3, num_threads=16, layout="frames",
+                      dtype="float32", scale="bin", load=np.load):
+    """
+        Packs per-utterance .npy spectrograms into a few large shard files
+
+        utterances: list of .npy paths, stored under the exact same strings
+        store_dir: output directory (shards, index.npz and meta.json)
+        shard_bytes: a new shard is started once the current one exceeds this
+        num_threads: concurrent reads, mostly useful on network file systems
+        layout: one of LAYOUTS
+        dtype: one of DTYPES, the storage precision
+        scale: one of SCALES, granularity of the uint8 quantization
+        load: reads the (n_bins, frames) spectrogram of an utterance path
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("unknown layout {}, expected one of {}".format(layout, LAYOUTS))
+    if dtype not in DTYPES or scale not in SCALES:
+        raise ValueError("unknown dtype {} or scale {}, expected one of {} and {}".format(dtype, scale, DTYPES, SCALES))
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+    shards = []
+    shard_of = np.zeros(len(utterances), dtype=np.int32)
+    offset_of = np.zeros(len(utterances), dtype=np.int64)
+    length_of = np.zeros(len(utterances), dtype=np.int64)
+    qscale, qoffset = [], []
+    n_bins = None
+
+    out = None
+    written = 0
+    with ThreadPoolExecutor(num_threads) as pool:
+        for i, x in enumerate(pool.map(load, utterances)):
+            if n_bins is None:
+                n_bins = x.shape[0]
+            if x.shape[0] != n_bins:
+                raise ValueError("{} has {} frequency bins, expected {}".format(
+                    utterances[i], x.shape[0], n_bins))
+            if out is None or written >= shard_bytes:
+                if out is not None:
+                    out.close()
+                shards.append(SHARD_FILE.format(len(shards)))
+                out = open(os.path.join(store_dir, shards[-1]), "wb")
+                written = 0
+            length_of[i] = x.shape[1]
+            if dtype == "uint8":
+                x, step, low = quantize(x, scale)
+                qscale.append(step)
+                qoffset.append(low)
+            if layout == "frames":
+                x = x.T
+            x = np.ascontiguousarray(x, dtype=dtype)
+            shard_of[i] = len(shards)-1
+            offset_of[i] = written // x.itemsize
+            x.tofile(out)
+            written += x.nbytes
+    if out is not None:
+        out.close()
+
+    columns = {"paths": np.array(utterances), "shard": shard_of, "offset": offset_of, "length": length_of}
+    if dtype == "uint8":
+        columns["qscale"] = np.array(qscale, dtype=np.float32)
+        columns["qoffset"] = np.array(qoffset, dtype=np.float32)
+    np.savez(os.path.join(store_dir, INDEX_FILE), **columns)
+    meta = {"n_bins": n_bins, "dtype": dtype, "layout": layout, "shards": shards}
+    if dtype == "uint8":
+        meta["scale"] = scale
+    with open(os.path.join(store_dir, META_FILE), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def recording_length(path):
+    # a memory-mapped load only parses the .npy header
+    return np.load(path, mmap_mode="r").shape[1]
+
+
+def index_lengths(utterances, lengths_file, num_threads=16):
+    """
+        Records the number of frames of every utterance from the .npy headers
+
+        utterances: list of .npy paths
+        lengths_file: output .npz with the paths and their lengths
+    """
+    with ThreadPoolExecutor(num_threads) as pool:
+        lengths = np.fromiter(pool.map(recording_length, utterances), dtype=np.int64, count=len(utterances))
+    np.savez(lengths_file, paths=np.array(utterances), length=lengths)
+    return lengths
+
+
+def load_lengths(lengths_file, paths):
+    """
+        Returns the number of frames of each of paths from a file written by index_lengths
+    """
+    index = np.load(lengths_file)
+    return index["length"][lookup_paths(index["paths"], paths, "utterances", lengths_file)]
@@ -1,31 +1,68 @@
 import os
-import sys
 import time
+import signal
+import argparse
 import random 
 import math 
 import numpy as np 
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, RandomSampler
 from torch import save, dist, load
 from itertools import chain
 from networks import VGGVoxWrapper, Dictionary, VGGVox
-from dataloader import VoxCelebVGGFace
-from utils_v2f import Logger
-from PIL import Image 
-import wandb
-wandb.init(project="v2f")
+from dataloader import VoxCelebVGGFace, collate, pad_collate
+from sampler import BucketBatchSampler, ResumableBatchSampler, fixed_padding_waste
+from readahead import ReadAheadLoader
+from orthogonal import Orthogonalizer
+from embedding_cache import open_embedding_cache
+from closed_form import fit_dictionary
+from metrics import RunningMetrics
+from device import select_device, bf16_supported, configure_cpu_threads, prepare_network, autocast
+from utils_v2f import Logger, STATE_FILE
+from sinks import open_sinks
+from distributed import (init_distributed, local_processes, local_rank, broadcast_state,
+                         GradientAllReduce, any_rank, average, cleanup)
 
 # TRAINING HYPERPARAMETERS
 EPOCHS = 100000
 BATCHSIZE = 2
+ACCUMULATION_STEPS = 1 # micro-batches of BATCHSIZE whose gradients are summed before each optimizer step
 LEARNING_RATE = 0.001
 NUM_WORKERS = 64
 RANDOM_SEED = 15213
+SEGMENT_LENGTH = 400 # frames per crop, None uses full utterances (requires VARIABLE_LENGTH)
+VARIABLE_LENGTH = False # batch samples of similar length and pool over their real frames only
+BATCH_FETCH = True # workers build whole batches with dataset.get_batch instead of one sample at a time
+CROPS_PER_UTTERANCE = 1 # random crops taken from every loaded utterance (needs BATCH_FETCH when > 1)
+READ_AHEAD = 0 # batches read ahead by a thread pool instead of DataLoader workers, 0 disables it
+READ_AHEAD_THREADS = 64 # concurrent reads of the read-ahead loader
+CACHE_GB = 0 # decoded spectrograms kept in RAM, shared by the workers of the node, 0 disables it
+ORTHOGONALIZE = "qr" # keeps the face dictionary orthonormal: "qr", "gram_schmidt" or "parametrization"
+ORTHOGONALIZE_EVERY = 1 # steps between re-orthonormalizations ("qr" and "gram_schmidt")
+FREEZE_VOICE = False # keep the pretrained voice network fixed and train the dictionary from cached embeddings
+EMBEDDING_CROPS = 10 # random crops of every utterance embedded into the cache when FREEZE_VOICE
+SOLVE_DICTIONARY = None # with FREEZE_VOICE, "ridge" or "orthogonal" solves the dictionary in closed form instead of training it
+RIDGE = 1e-3 # regularization of the "ridge" solver
+DEVICE = None # "cuda" or "cpu", None picks cuda when available
+CPU_THREADS = None # intra-op threads on the cpu, None leaves WORKER_CORE_SHARE of a core per DataLoader worker
+WORKER_CORE_SHARE = 0.25 # cores counted per DataLoader worker when sizing CPU_THREADS (they mostly wait on reads)
+CHANNELS_LAST = None # channels-last convolutions (the layout oneDNN prefers), None uses them on the cpu only
+BF16 = None # bfloat16 autocast where the device supports it natively, None uses it on the cpu only
+LOG_EVERY = 50 # steps between two minibatch logs, the losses are only copied to the host then
 # WHERE TO WRITE MODELS
 OUTDIRPATH = "models"
 LOGGER = None
+SINK = None
+SINKS = ["jsonl", "wandb"] # "jsonl" writes metrics.jsonl and PNGs into the run directory, "wandb" logs to Weights & Biases
+WANDB_PROJECT = "v2f"
+KEEP_CHECKPOINTS = 5 # epochs whose checkpoints are kept, None keeps all of them
+KEEP_BEST = True # also keep the checkpoint of the epoch with the lowest loss
+PREEMPTED = False # set by SIGTERM, the training then saves its state at the next optimizer step and exits
+DISTRIBUTED_BACKEND = "gloo" # process group backend when launched with torchrun (WORLD_SIZE > 1)
+RANK = 0 # rank of this process, only rank 0 logs and writes checkpoints
+WORLD_SIZE = 1 # training processes, each takes 1/WORLD_SIZE of the batches of an epoch
 ALPHA = 1
 BETA = 1
 # VGGVOX_WEIGHTS = "/share/workhorse3/mahmoudi/voice_to_face_net/src/saved/models/Voice2Face_SpeakerID_VGGVox/0213_120446/model_best.pth"
@@ -35,6 +72,61 @@ VGGVOX_WEIGHTS = "/share/workhorse3/mahmoudi/voice_to_face_net/speaker_id_weight
 np.random.seed(RANDOM_SEED)
 torch.manual_seed(RANDOM_SEED)
 
+
+class Preempted(Exception):
+    """
+        Raised by an epoch that stopped on SIGTERM after batches_done batches
+    """
+    def __init__(self, batches_done):
+        super().__init__(batches_done)
+        self.batches_done = batches_done
+
+
+def request_stop(signum, frame):
+    global PREEMPTED
+    PREEMPTED = True
+
+
+def rng_states():
+    # plain python types and tensors only, so torch.load can read them back safely
+    name, key, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {"python": random.getstate(), "numpy": (name, key.tolist(), pos, has_gauss, cached_gaussian),
+            "torch": torch.get_rng_state(),
+            "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_states(states):
+    random.setstate(states["python"])
+    name, key, pos, has_gauss, cached_gaussian = states["numpy"]
+    np.random.set_state((name, np.array(key, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(states["torch"])
+    if torch.cuda.is_available() and len(states["cuda"]) > 0:
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def training_state(networks, optimizer, scheduler, orthogonalizer, epoch, batch):
+    """
+        Everything needed to continue the run at batch of epoch
+    """
+    voice_network, face_network = networks
+    return {"voice_network": voice_network.state_dict(), "face_network": face_network.state_dict(),
+            "optimizer": optimizer.state_dict(), "scheduler": scheduler.state_dict(),
+            "orthogonalize_steps": orthogonalizer.steps, "epoch": epoch, "batch": batch, "rng": rng_states()}
+
+
+def load_training_state(state, networks, optimizer, scheduler, orthogonalizer):
+    """
+        Restores a training_state, returns the epoch and batch to continue from
+    """
+    voice_network, face_network = networks
+    voice_network.load_state_dict(state["voice_network"])
+    face_network.load_state_dict(state["face_network"])
+    optimizer.load_state_dict(state["optimizer"])
+    scheduler.load_state_dict(state["scheduler"])
+    orthogonalizer.steps = state["orthogonalize_steps"]
+    set_rng_states(state["rng"])
+    return state["epoch"], state["batch"]
+
 def val_model(model, n_epoch, dataloader):
     global LOGGER
     model.eval()
@@ -70,37 +162,20 @@ def val_model(model, n_epoch, dataloader):
     LOGGER.log_accuracy("validation", n_epoch, accuracy, avgloss)
     return avgloss, accuracy
 
-# source: https://github.com/legendongary/pytorch-gram-schmidt
-def gram_schmidt(vv):
-    def projection(u, v):
-        return (v * u).sum() / (u * u).sum() * u
-
-    nk = vv.size(1) # debugged from original repo
-    uu = torch.zeros_like(vv, device=vv.device)
-    uu[:, 0] = vv[:, 0].clone() # copy first column
-    for k in range(1, nk):
-        vk = vv[:, k].clone() # debugged from original repo
-        uk = 0
-        for j in range(0, k): # project vk onto space spanned by bases so far
-            uj = uu[:, j].clone()
-            uk = uk + projection(uj, vk)
-        uu[:, k] = vk - uk
-    for k in range(nk):
-        uk = uu[:, k].clone()
-        uu[:, k] = uk / uk.norm()
-    return uu
-
-
-def run_epoch(n_epoch, networks, dataloader, optimizer, epoch):
-    global LOGGER
+def run_epoch(n_epoch, networks, dataloader, optimizer, epoch, orthogonalizer, device, bf16=False, start_batch=0,
+              all_reduce=None):
+    """
+        start_batch: batches of the epoch already trained on, when resuming
+        (the sampler of dataloader skips them)
+        all_reduce: averages the gradients over the ranks before every optimizer step
+    """
+    global LOGGER, SINK
 
     cross_entropy = nn.CrossEntropyLoss()
     mse = nn.MSELoss()
 
-    iters = 0.0
-    total_loss = 0.0
-    total_spkr_id = 0 
-    total_face_recon = 0 
+    iters = float(start_batch)
+    metrics = RunningMetrics(["LOSS", "SPEAKER ID LOSS", "FACE RECONSTRUCTION"], device, LOG_EVERY)
 
     start_time = time.time()
 
@@ -109,8 +184,11 @@ def run_epoch(n_epoch, networks, dataloader, optimizer, epoch):
     dup_face = None
     dup_gen = None 
 
-    for index, (utt, face, y) in enumerate(dataloader):
-        optimizer.zero_grad()
+    optimizer.zero_grad()
+    for index, batch in enumerate(dataloader, start_batch):
+        utt, face, y = batch[:3]
+        # lengths of the samples, only given by pad_collate
+        lengths = batch[3] if len(batch) > 3 else None
 
         # update number of iterations 
         iters += 1 
@@ -118,112 +196,336 @@ def run_epoch(n_epoch, networks, dataloader, optimizer, epoch):
         # get the data loading time 
         end_time = time.time()
    
-        # feed the audio to get the embedding 
-        embedding = voice_network(utt.float().cuda())
-        # generate the face 
-        gen_face = face_network(embedding)
+        with autocast(device, bf16):
+            # feed the audio to get the embedding 
+            embedding = voice_network(utt.to(device), lengths=lengths)
+            # generate the face 
+            gen_face = face_network(embedding)
+            logits = voice_network(embedding, loss=True)
         
         # take a copy of the orignal face 
         dup_face = face
         # take a copy of the generated face 
-        dup_gen = gen_face
+        dup_gen = gen_face.detach()
 
-        # calculate the loss 
-        y = y.cuda()
-        logits = voice_network(embedding, loss=True)
-        loss_speakerid = cross_entropy(logits, y)
-        loss_face_recon = mse(gen_face, face.float().cuda())
-
-        total_spkr_id += loss_speakerid.item()
-        total_face_recon += loss_face_recon.item()
+        # calculate the loss (in float32 under bf16 autocast)
+        y = y.to(device)
+        loss_speakerid = cross_entropy(logits.float(), y)
+        # faces arrive as uint8, converted on the device
+        loss_face_recon = mse(gen_face.float(), face.to(device).float())
 
         # combine the loss 
         loss = ALPHA * loss_speakerid + BETA * loss_face_recon
-
-        total_loss += loss.item()
-        loss.backward()
-        optimizer.step()
-        
-        # Orthogalize the face embeddings 
-        face_network.linear.weight.data = gram_schmidt(face_network.linear.weight.data)
-
-        all_losses = {"LOSS": loss.item(), 
-                      "SPEAKER ID LOSS": loss_speakerid.item(), 
-                      "FACE RECONSTRUCTION": loss_face_recon.item()}
-        LOGGER.log_minibatch(index, n_epoch, all_losses)
-        all_losses["batch"] = index 
-        wandb.log(all_losses)
-
-    
-    # code to output generated faces during training 
-    dup_face = dup_face.detach().cpu().numpy()
-    dup_gen = dup_gen.detach().cpu().numpy()
-    dup_face_img = Image.fromarray(dup_face[1,:].reshape(128, 128).astype(np.uint8))
-    dup_gen_img = Image.fromarray(dup_gen[1,:].reshape(128, 128).astype(np.uint8))
+        metrics.add(loss, loss_speakerid, loss_face_recon)
+
+        # scaled so the accumulated gradient is the mean over the effective batch,
+        # every backward frees its graph so memory does not grow with the accumulation
+        (loss / ACCUMULATION_STEPS).backward()
+        if iters % ACCUMULATION_STEPS == 0:
+            if all_reduce is not None:
+                all_reduce()
+            optimizer.step()
+            optimizer.zero_grad()
+            # Orthogalize the face embeddings 
+            orthogonalizer.step()
+            # every rank has to stop at the same step
+            if any_rank(PREEMPTED):
+                raise Preempted(int(iters))
+
+        if metrics.due():
+            all_losses = metrics.flush()
+            if RANK == 0:
+                LOGGER.log_minibatch(index, n_epoch, all_losses, force=True)
+                all_losses["batch"] = index 
+                SINK.log(all_losses)
+
+
+    # step on the micro-batches left at the end of the epoch, rescaled to their mean
+    remainder = int(iters) % ACCUMULATION_STEPS
+    if remainder > 0:
+        if all_reduce is not None:
+            all_reduce()
+        step_partial_accumulation(optimizer, ACCUMULATION_STEPS/remainder)
+        orthogonalizer.step()
+
+    # code to output generated faces during training, the images are encoded by the sink thread
+    dup_face_img = dup_face[1].cpu().numpy().reshape(128, 128)
+    dup_gen_img = dup_gen[1].float().cpu().numpy().reshape(128, 128)
 
     end_time = time.time()
-    avgloss = total_loss/iters #@FIXME: iters --> can be updated to len(dataloader)
-    avgloss_speaker_id = total_spkr_id/iters
-    avgloss_face = total_face_recon/iters
-
-    LOGGER.log_epoch(n_epoch, "train", {"EPOCH LOSS": avgloss, "SPEAKER ID LOSS": avgloss_speaker_id, "FACE ID LOSS": avgloss_face})
-
-    wandb.log({"epoch": n_epoch+1, "loss": avgloss, "original_face": [wandb.Image(dup_face_img)], "reconstructed_face": [wandb.Image(dup_gen_img)]})
+    # the mean over all ranks, so every rank returns the same epoch loss
+    epoch_means = average(metrics.means())
+    avgloss = epoch_means["LOSS"]
+    avgloss_speaker_id = epoch_means["SPEAKER ID LOSS"]
+    avgloss_face = epoch_means["FACE RECONSTRUCTION"]
+
+    epoch_logs = {"EPOCH LOSS": avgloss, "SPEAKER ID LOSS": avgloss_speaker_id, "FACE ID LOSS": avgloss_face}
+    batch_sampler = dataloader.batch_sampler or dataloader.sampler
+    if hasattr(batch_sampler, "padding_waste"):
+        epoch_logs["PADDING WASTE %"] = 100*batch_sampler.padding_waste()
+    if hasattr(dataloader, "stats"):
+        epoch_logs.update(dataloader.stats())
+    if dataloader.dataset.cache is not None:
+        epoch_logs.update(dataloader.dataset.cache.stats())
+        dataloader.dataset.cache.reset_stats()
+    if RANK == 0:
+        LOGGER.log_epoch(n_epoch, "train", epoch_logs)
+        SINK.log({"epoch": n_epoch+1, "loss": avgloss},
+                 {"original_face": dup_face_img, "reconstructed_face": dup_gen_img})
 
     accuracy = 0
     return avgloss, accuracy
 
-def train(train_dataset):
-    global LOGGER
+def step_partial_accumulation(optimizer, scale):
+    """
+        Optimizer step on gradients accumulated over fewer micro-batches than
+        ACCUMULATION_STEPS, scale is ACCUMULATION_STEPS over their number
+    """
+    for group in optimizer.param_groups:
+        for p in group["params"]:
+            if p.grad is not None:
+                p.grad.mul_(scale)
+    optimizer.step()
+    optimizer.zero_grad()
+
+
+def run_cached_epoch(n_epoch, face_network, cache, optimizer, orthogonalizer, device, start_batch=0):
+    """
+        Trains the dictionary for one epoch over the cached embeddings of a frozen voice network,
+        the order of an epoch only depends on its number so it can be resumed at start_batch
+    """
+    global LOGGER, SINK
+    mse = nn.MSELoss()
+
+    metrics = RunningMetrics(["FACE RECONSTRUCTION"], device, LOG_EVERY)
+    # gathering embeddings is cheap, so the effective batch is taken in one piece
+    batches = cache.batches(BATCHSIZE*ACCUMULATION_STEPS, device, seed=RANDOM_SEED+n_epoch, start=start_batch)
+    for index, (embedding, face, y) in enumerate(batches, start_batch):
+        optimizer.zero_grad()
+        gen_face = face_network(embedding)
+        loss = mse(gen_face, face.float())
+        loss.backward()
+        optimizer.step()
+        orthogonalizer.step()
+        if PREEMPTED:
+            raise Preempted(index+1)
+
+        metrics.add(loss)
+        if metrics.due():
+            all_losses = metrics.flush()
+            LOGGER.log_minibatch(index, n_epoch, all_losses, force=True)
+            all_losses["batch"] = index
+            SINK.log(all_losses)
+
+    dup_face_img = face[0].cpu().numpy().reshape(128, 128)
+    dup_gen_img = gen_face[0].detach().cpu().numpy().reshape(128, 128)
+
+    avgloss = metrics.means()["FACE RECONSTRUCTION"]
+    LOGGER.log_epoch(n_epoch, "train", {"EPOCH LOSS": avgloss, "FACE ID LOSS": avgloss})
+    SINK.log({"epoch": n_epoch+1, "loss": avgloss},
+             {"original_face": dup_face_img, "reconstructed_face": dup_gen_img})
+    return avgloss, 0
+
+
+def make_dataloader(dataset):
+    # an epoch visits every utterance once and yields CROPS_PER_UTTERANCE samples for each,
+    # so the sampler draws BATCHSIZE/CROPS_PER_UTTERANCE utterances per batch
+    if CROPS_PER_UTTERANCE > 1 and not (BATCH_FETCH or READ_AHEAD > 0):
+        print("CROPS_PER_UTTERANCE > 1 needs BATCH_FETCH or READ_AHEAD")
+        exit(1)
+    utterances_per_batch = max(1, BATCHSIZE // CROPS_PER_UTTERANCE)
+
+    if VARIABLE_LENGTH:
+        if dataset.lengths is None:
+            print("VARIABLE_LENGTH needs --spectrogram-store or --lengths-index")
+            exit(1)
+        sampler = BucketBatchSampler(dataset.lengths, utterances_per_batch, max_frames=SEGMENT_LENGTH,
+                                     drop_last=True)
+        if SEGMENT_LENGTH is not None:
+            print("padding waste of fixed {} frame crops: {:.2f}%".format(
+                SEGMENT_LENGTH, 100*fixed_padding_waste(dataset.lengths, SEGMENT_LENGTH)))
+    else:
+        sampler = BatchSampler(RandomSampler(dataset), utterances_per_batch, drop_last=True)
+    # the batch order of an epoch is reproducible, so an interrupted epoch can be resumed
+    sampler = ResumableBatchSampler(sampler, RANDOM_SEED, num_replicas=WORLD_SIZE, rank=RANK)
+
+    if READ_AHEAD > 0:
+        return ReadAheadLoader(dataset, sampler, depth=READ_AHEAD, num_threads=READ_AHEAD_THREADS)
+    if BATCH_FETCH:
+        # the sampler yields lists of indices, every worker returns a collated batch
+        return DataLoader(dataset, batch_size=None, sampler=sampler, num_workers=NUM_WORKERS)
+    return DataLoader(dataset, batch_sampler=sampler, num_workers=NUM_WORKERS,
+                      collate_fn=pad_collate if VARIABLE_LENGTH else collate)
+
+
+def train(args):
+    global LOGGER, SINK, RANK, WORLD_SIZE
+    train_dataset = args.dataset_mapping
+
+    # with torchrun every process trains on its shard of each epoch
+    RANK, WORLD_SIZE = init_distributed(DISTRIBUTED_BACKEND)
+    if WORLD_SIZE > 1 and FREEZE_VOICE:
+        print("FREEZE_VOICE trains from a single embedding cache and is not distributed, run it in one process")
+        exit(1)
 
     # init the datasets & data loaders 
-    dataset = VoxCelebVGGFace(train_dataset, ["train"])
-    data_loader = DataLoader(dataset, BATCHSIZE, shuffle=True, num_workers=NUM_WORKERS, drop_last=True)
+    dataset = VoxCelebVGGFace(train_dataset, ["train"], segment_length=SEGMENT_LENGTH,
+                              spectrogram_store=args.spectrogram_store, face_store=args.face_store,
+                              lengths_index=args.lengths_index, pad=not VARIABLE_LENGTH,
+                              crops_per_utterance=1 if FREEZE_VOICE else CROPS_PER_UTTERANCE,
+                              cache_bytes=int(CACHE_GB*1024**3), normalization=args.normalization)
+    data_loader = make_dataloader(dataset)
 
     # init the testing dataset & data loader
-    dataset_test = VoxCelebVGGFace(train_dataset, ["test"])
-    data_loader_test = DataLoader(dataset, BATCHSIZE, shuffle=True, num_workers=NUM_WORKERS, drop_last=True)
+    dataset_test = VoxCelebVGGFace(train_dataset, ["test"], segment_length=SEGMENT_LENGTH,
+                                   spectrogram_store=args.spectrogram_store, face_store=args.face_store,
+                                   lengths_index=args.lengths_index, pad=not VARIABLE_LENGTH,
+                                   crops_per_utterance=CROPS_PER_UTTERANCE, normalization=args.normalization)
+    # mapping files without a test split still train (the loader is not used yet)
+    data_loader_test = make_dataloader(dataset_test) if len(dataset_test) > 0 else None
 
     # init the model
-    voice_network = VGGVoxWrapper(257, 128).cuda()
-    face_network = Dictionary(128, 128*128).cuda()
-
-    voice_network.load_state_dict(load(VGGVOX_WEIGHTS))
-
-    optimizer = optim.Adam(chain(voice_network.parameters(), face_network.parameters()), lr=LEARNING_RATE)
+    device = select_device(DEVICE)
+    if device.type == "cuda" and WORLD_SIZE > 1:
+        device = torch.device("cuda", local_rank())
+    if device.type == "cpu":
+        # the read-ahead loader reads on threads of this process, no DataLoader workers are started
+        workers = 0 if READ_AHEAD > 0 else NUM_WORKERS
+        threads = configure_cpu_threads(workers, CPU_THREADS, local_processes(), WORKER_CORE_SHARE)
+        print("rank {}/{} training on {} cpu threads next to {} DataLoader workers".format(
+            RANK, WORLD_SIZE, threads, workers))
+    # the cpu options stay off on the gpu unless they are asked for
+    on_cpu = device.type == "cpu"
+    bf16 = (on_cpu if BF16 is None else BF16) and bf16_supported(device)
+    channels_last = on_cpu if CHANNELS_LAST is None else CHANNELS_LAST
+    voice_network = VGGVoxWrapper(257, 128)
+    face_network = Dictionary(128, 128*128).to(device)
+
+    voice_network.load_state_dict(load(VGGVOX_WEIGHTS, map_location="cpu"))
+    voice_network = prepare_network(voice_network, device, channels_last)
+    # a parametrization replaces the weight parameter, so it goes before the optimizer
+    orthogonalizer = Orthogonalizer(face_network.linear, method=ORTHOGONALIZE, every=ORTHOGONALIZE_EVERY,
+                                    broadcast=WORLD_SIZE > 1)
+
+    if FREEZE_VOICE:
+        # embed every utterance once, the epochs then only touch the dictionary
+        embedding_cache = open_embedding_cache(dataset, voice_network, args.embedding_cache, VGGVOX_WEIGHTS,
+                                               EMBEDDING_CROPS, batch_size=BATCHSIZE, device=device,
+                                               num_workers=NUM_WORKERS)
+        optimizer = optim.Adam(face_network.parameters(), lr=LEARNING_RATE)
+    else:
+        optimizer = optim.Adam(chain(voice_network.parameters(), face_network.parameters()), lr=LEARNING_RATE)
     scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=3)
+    networks = [voice_network, face_network]
 
+    start_epoch, start_batch = 0, 0
+    if args.resume is not None:
+        state = load(os.path.join(args.resume, STATE_FILE), map_location="cpu")
+        start_epoch, start_batch = load_training_state(state, networks, optimizer, scheduler, orthogonalizer)
+        print("resuming {} at epoch {}, batch {}".format(args.resume, start_epoch+1, start_batch))
+    # every rank starts from the weights of rank 0
+    broadcast_state(networks)
+    all_reduce = GradientAllReduce(chain(voice_network.parameters(), face_network.parameters())) if WORLD_SIZE > 1 else None
 
     # init the logger
-    config = {"epochs": EPOCHS, "lr": LEARNING_RATE, "batch_size": BATCHSIZE,
-              "random_seed": RANDOM_SEED, "dataset_size": len(dataset)}
-
-
-    LOGGER = Logger(OUTDIRPATH, config, {"VOICE_NETWORK": voice_network, "FACE_NETWORK": face_network})
-
-    config["timestamp"] = LOGGER.current_timestamp
-    config["alpha"] = ALPHA
-    config["beta"]  = BETA
-    wandb.config.update(config)
-
-    networks = [voice_network, face_network]
-
-    for epoch in range(EPOCHS):
-        print("Epoch: {}".format(epoch+1))
-        # train an epoch 
-        epoch_loss, epoch_acc = run_epoch(epoch, networks, data_loader, optimizer, epoch)
-        #@TODO: implement validation model 
-        # validate the model 
-        # val_loss, epoch_acc = val_model(net, epoch, val_data_loader)
-        # check point 
-        LOGGER.checkpoint(epoch)
-        # write out the logs 
-        LOGGER.write_logs()
-        # poke your scheduler if you wish...
-        # scheduler.step(epoch_loss)
+    # batch_size counts the samples of a step over all ranks, the progress of the logs is that of the whole run
+    config = {"epochs": EPOCHS, "lr": LEARNING_RATE, "batch_size": BATCHSIZE*WORLD_SIZE,
+              "accumulation_steps": ACCUMULATION_STEPS, "world_size": WORLD_SIZE,
+              "effective_batch_size": BATCHSIZE*ACCUMULATION_STEPS*WORLD_SIZE,
+              "random_seed": RANDOM_SEED, "dataset_size": len(dataset)*CROPS_PER_UTTERANCE,
+              "crops_per_utterance": CROPS_PER_UTTERANCE,
+              "orthogonalize": ORTHOGONALIZE, "orthogonalize_every": ORTHOGONALIZE_EVERY,
+              "freeze_voice": FREEZE_VOICE, "solve_dictionary": SOLVE_DICTIONARY,
+              "device": device.type, "channels_last": channels_last, "bf16": bf16}
+    if FREEZE_VOICE:
+        config["dataset_size"] = len(embedding_cache)
+        config["embedding_crops"] = EMBEDDING_CROPS
+
+
+    # only rank 0 writes logs, metrics and checkpoints
+    if RANK == 0:
+        LOGGER = Logger(OUTDIRPATH, config, {"VOICE_NETWORK": voice_network, "FACE_NETWORK": face_network},
+                        keep_last=KEEP_CHECKPOINTS, keep_best=KEEP_BEST, resume_dir=args.resume)
+
+        config["timestamp"] = LOGGER.current_timestamp
+        config["alpha"] = ALPHA
+        config["beta"]  = BETA
+        # metrics and images go through a background thread, the training never waits for them
+        SINK = open_sinks(SINKS, LOGGER.outdir, WANDB_PROJECT)
+        SINK.config(config)
+
+    # on preemption the state is saved at the next optimizer step, before the grace period ends
+    signal.signal(signal.SIGTERM, request_stop)
+    sampler = data_loader.batch_sampler or data_loader.sampler
+    if FREEZE_VOICE:
+        batches_per_epoch = len(embedding_cache) // (BATCHSIZE*ACCUMULATION_STEPS)
+    else:
+        batches_per_epoch = len(data_loader)
+
+    try:
+        if FREEZE_VOICE and SOLVE_DICTIONARY is not None:
+            mse = fit_dictionary(face_network, embedding_cache, SOLVE_DICTIONARY, RIDGE)
+            LOGGER.log_epoch(0, "train", {"FACE ID LOSS": mse, "SOLVER": SOLVE_DICTIONARY})
+            LOGGER.checkpoint(0)
+            LOGGER.write_logs()
+            return
+
+        for epoch in range(start_epoch, EPOCHS):
+            if RANK == 0:
+                print("Epoch: {}".format(epoch+1))
+            first_batch = start_batch if epoch == start_epoch else 0
+            # train an epoch 
+            try:
+                if FREEZE_VOICE:
+                    epoch_loss, epoch_acc = run_cached_epoch(epoch, face_network, embedding_cache, optimizer,
+                                                             orthogonalizer, device, first_batch)
+                else:
+                    sampler.set_epoch(epoch, first_batch)
+                    epoch_loss, epoch_acc = run_epoch(epoch, networks, data_loader, optimizer, epoch, orthogonalizer,
+                                                      device, bf16, first_batch, all_reduce)
+            except Preempted as stop:
+                # stopped on the last step of the epoch: continue with the next one
+                position = (epoch+1, 0) if stop.batches_done >= batches_per_epoch else (epoch, stop.batches_done)
+                if RANK == 0:
+                    LOGGER.save_state(training_state(networks, optimizer, scheduler, orthogonalizer, *position),
+                                      wait=True)
+                    print("SIGTERM: state saved at epoch {}, batch {}, resume with --resume {}".format(
+                        position[0]+1, position[1], LOGGER.outdir))
+                return
+            # batch norm statistics differ between the shards, the ranks continue with those of rank 0
+            broadcast_state(networks)
+            #@TODO: implement validation model 
+            # validate the model 
+            # val_loss, epoch_acc = val_model(net, epoch, val_data_loader)
+            if RANK == 0:
+                # check point (written in the background)
+                LOGGER.checkpoint(epoch, epoch_loss)
+                LOGGER.save_state(training_state(networks, optimizer, scheduler, orthogonalizer, epoch+1, 0))
+                LOGGER.log_epoch(epoch, "checkpoint", LOGGER.checkpoint_stats())
+                # write out the logs 
+                LOGGER.write_logs()
+            # poke your scheduler if you wish...
+            # scheduler.step(epoch_loss)
+    finally:
+        if RANK == 0:
+            # writes out the queued metrics and checkpoints
+            SINK.close()
+            LOGGER.close()
+        cleanup()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python train.py dataset_mapping")
-        exit(1)
-    train(sys.argv[1])
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train the voice to face network")
+    parser.add_argument("dataset_mapping", help="file with split,utterance,face,label per line, or its compiled manifest (.npz)")
+    parser.add_argument("--spectrogram-store", default=None,
+                        help="directory written by `pack_data.py spectrograms` for the same mapping")
+    parser.add_argument("--face-store", default=None,
+                        help="directory written by `pack_data.py faces` for the same mapping")
+    parser.add_argument("--lengths-index", default=None,
+                        help="file written by `pack_data.py lengths` for the same mapping")
+    parser.add_argument("--normalization", default=None,
+                        help="per-bin statistics written by `pack_data.py stats`, applied to every batch")
+    parser.add_argument("--embedding-cache", default="embedding_cache",
+                        help="directory of the voice embeddings used when FREEZE_VOICE is set")
+    parser.add_argument("--resume", default=None,
+                        help="output directory of an interrupted run, continued from its training state")
+    train(parser.parse_args())
\ No newline at end of file
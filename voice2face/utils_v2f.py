@@ -1,12 +1,123 @@
 import os
+import re
+import time
+import queue
+import threading
 from datetime import datetime
-from torch import save
+from torch import save, Tensor
+from orthogonal import plain_state_dict
 from math import sqrt, floor
 from collections import defaultdict
 import json 
 import pickle 
 
 
+STATE_FILE = "training_state.pt"
+
+
+def to_cpu(state):
+    """
+        Copy of a (nested) state dict with every tensor copied to cpu memory
+    """
+    if isinstance(state, Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {k: to_cpu(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+class CheckpointWriter:
+    """
+        Writes checkpoints on a background thread and applies the retention policy
+
+        Every file is written to a temporary name and renamed once complete, so
+        a crash never leaves a truncated checkpoint behind. At most one snapshot
+        waits for the thread: a checkpoint taken while the previous one is still
+        being written waits for it, which bounds the memory to two snapshots.
+
+        keep_last: epochs whose checkpoints are kept (None keeps all of them)
+        keep_best: also keep the checkpoint of the epoch with the lowest metric
+    """
+
+    def __init__(self, keep_last=None, keep_best=True):
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.saved = [] # epochs on disk, oldest first
+        self.files = {} # epoch -> its checkpoint files
+        self.best = None # (metric, epoch)
+        self.write_time = 0.0
+        self.error = None
+        self.queue = queue.Queue(1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, n_epoch, snapshots, metric=None):
+        """
+            snapshots: {path: state dict already copied to cpu memory}
+            n_epoch: None for files outside the retention policy
+        """
+        self._raise()
+        self.queue.put((n_epoch, snapshots, metric))
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            try:
+                self._write(*job)
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+    def _write(self, n_epoch, snapshots, metric):
+        start = time.time()
+        for path, state in snapshots.items():
+            save(state, path + ".tmp")
+            os.replace(path + ".tmp", path)
+        if n_epoch is None:
+            self.write_time += time.time() - start
+            return
+        self.saved.append(n_epoch)
+        self.files[n_epoch] = list(snapshots)
+        if metric is not None and (self.best is None or metric < self.best[0]):
+            self.best = (metric, n_epoch)
+        self._apply_retention()
+        self.write_time += time.time() - start
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+        keep = set(self.saved[-self.keep_last:])
+        if self.keep_best and self.best is not None:
+            keep.add(self.best[1])
+        for n_epoch in [e for e in self.saved if e not in keep]:
+            for path in self.files.pop(n_epoch):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.saved.remove(n_epoch)
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def wait(self):
+        """
+            Blocks until every submitted checkpoint is on disk
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+
 class Logger:
     """
         ADD DESCRIPTION
@@ -20,9 +131,14 @@ class Logger:
             "dataset_size":...
         }
         networks: ["network1":..., "network2":...]
+        keep_last: number of epochs whose checkpoints are kept, None keeps them all
+        keep_best: also keep the checkpoint with the lowest metric passed to checkpoint()
+        resume_dir: output directory of an earlier run to continue, its logs are kept
+                    and its best checkpoint is found again from their "EPOCH LOSS"
+                    (the metric train.py checkpoints with)
     """
 
-    def __init__(self, model_dir, config, networks):
+    def __init__(self, model_dir, config, networks, keep_last=None, keep_best=True, resume_dir=None):
         self.models = networks
         self.config = config
         self.epochs = config["epochs"]
@@ -35,23 +151,34 @@ class Logger:
         self.logs = defaultdict(lambda: len(self.logs))
 
         # create out directory
-        self.current_timestamp = self._get_timestamp()
-        
-        self.outdir = os.path.join(model_dir, self._get_timestamp())
+        if resume_dir is not None:
+            self.outdir = resume_dir
+            self.current_timestamp = os.path.basename(os.path.normpath(resume_dir))
+            self._load_logs()
+        else:
+            self.current_timestamp = self._get_timestamp()
+            self.outdir = os.path.join(model_dir, self._get_timestamp())
         self._create_folders(self.outdir)
 
         # write model parameters to a file 
         self._write_model_summary()
 
-    def log_minibatch(self, n_iter, n_epoch, losses):
+        self.writer = CheckpointWriter(keep_last, keep_best)
+        if resume_dir is not None:
+            self._track_checkpoints()
+        self.snapshot_time = 0.0
+        self.wait_time = 0.0
+
+    def log_minibatch(self, n_iter, n_epoch, losses, force=False):
         """
             logs information after running a minibatch using a log rate
 
             n_iter: iteration number 
             n_epoch: epoch number 
             losses: dictionary containing the losses {"LOSS_1":...,"LOSS_2:...} 
+            force: log regardless of the log rate (the caller already throttles)
         """
-        if n_iter % self.log_rate != 0:
+        if not force and n_iter % self.log_rate != 0:
             return
         n_files = (n_iter+1)*self.batch_size
         files_done = n_files/self.dataset_size
@@ -75,7 +202,9 @@ class Logger:
             else:
                 print("{}: {}".format(k,v))
 
-        self.logs[n_epoch+1] = {mode: data}
+        if not isinstance(self.logs.get(n_epoch+1), dict):
+            self.logs[n_epoch+1] = {}
+        self.logs[n_epoch+1][mode] = data
 
     def write_logs(self):
         """
@@ -85,6 +214,34 @@ class Logger:
         json.dump(self.logs, f, sort_keys=True, indent=4)
         f.close()
 
+    def _load_logs(self):
+        logs_file = os.path.join(self.outdir, "logs.json")
+        if os.path.isfile(logs_file):
+            with open(logs_file) as f:
+                for n_epoch, data in json.load(f).items():
+                    self.logs[int(n_epoch)] = data
+
+    def _track_checkpoints(self):
+        """
+            Puts the checkpoints already in the output directory under the retention policy
+        """
+        pattern = re.compile(r"_epoch_(\d+)\.weights$")
+        for f in sorted(os.listdir(self.outdir)):
+            match = pattern.search(f)
+            if match:
+                self.writer.files.setdefault(int(match.group(1)), []).append(os.path.join(self.outdir, f))
+        self.writer.saved = sorted(self.writer.files)
+
+        # otherwise the first epoch after resuming would replace the best checkpoint
+        losses = {}
+        for n_epoch in self.writer.saved:
+            logs = self.logs.get(n_epoch)
+            if isinstance(logs, dict) and "EPOCH LOSS" in logs.get("train", {}):
+                losses[n_epoch] = logs["train"]["EPOCH LOSS"]
+        if losses:
+            best = min(losses, key=losses.get)
+            self.writer.best = (losses[best], best)
+
     def _get_timestamp(self):
         timestamp = datetime.now()
         return timestamp.strftime("%d-%m-%Y--%H-%M-%S")
@@ -104,15 +261,49 @@ class Logger:
             f.write("{}: {}\n".format(c,v))
         f.close()
 
-    def checkpoint(self, n_epoch):
+    def checkpoint(self, n_epoch, metric=None):
         """
-            Checkpoints the models (self.models)
+            Checkpoints the models (self.models): their state dicts are copied to
+            cpu memory and written to disk by a background thread
 
             n_epoch: number of epoch
+            metric: value to minimize, used to keep the best checkpoint
         """
-
+        start = time.time()
+        snapshots = {}
         for k,v in self.models.items():
             outpath = os.path.join(self.outdir, "{}_epoch_{}.weights".format(k, n_epoch+1))
-            save(v.state_dict(), outpath)
+            # parametrized weights are written as their value, loadable by the plain modules
+            snapshots[outpath] = to_cpu(plain_state_dict(v))
+        copied = time.time()
+        self.writer.submit(n_epoch+1, snapshots, metric)
+        self.snapshot_time += copied - start
+        self.wait_time += time.time() - copied
+
+    def save_state(self, state, wait=False):
+        """
+            Writes the full training state (see train.py) to STATE_FILE in the
+            output directory, in the background unless wait is set
+        """
+        start = time.time()
+        snapshot = to_cpu(state)
+        copied = time.time()
+        self.writer.submit(None, {os.path.join(self.outdir, STATE_FILE): snapshot})
+        if wait:
+            self.writer.wait()
+        self.snapshot_time += copied - start
+        self.wait_time += time.time() - copied
 
-         
\ No newline at end of file
+    def checkpoint_stats(self):
+        """
+            Seconds spent checkpointing so far: on the training thread (copying
+            the weights, waiting for the previous write) and on the writer thread
+        """
+        return {"CHECKPOINT SNAPSHOT s": self.snapshot_time, "CHECKPOINT WAIT s": self.wait_time,
+                "CHECKPOINT WRITE s": self.writer.write_time}
+
+    def close(self):
+        """
+            Waits for the checkpoints still being written
+        """
+        self.writer.close()